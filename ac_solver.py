@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Newton-Raphson AC power flow for time series.
+
+Ybus is built once per topology (pypower makeYbus) and each hour is warm
+started from the previous solution, which typically needs far fewer
+iterations than a flat start. The fill-reducing column ordering of the
+Jacobian is computed at the first factorization and reused for later ones
+(the Jacobian has the same sparsity pattern every iteration and hour).
+
+The formulation follows pypower newtonpf (polar coordinates, PV buses at
+fixed voltage magnitude, reactive limits not enforced).
+"""
+
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+from numpy import flatnonzero as find
+from pypower.dSbus_dV import dSbus_dV
+from pypower.makeYbus import makeYbus
+from scipy.sparse.linalg import splu
+
+from dc_solver import topology_key
+
+logger = logging.getLogger("Nordic490.ac_solver")
+
+
+class ACSolver:
+    def __init__(self, baseMVA, bus, branch, gen, key=None):
+        """Build Ybus for a pypower case with internal bus numbering (bus i in row i).
+        Bus types (ref, pv, pq) and voltage set points are taken from bus and gen.
+        key: hash identifying the case, by default case_key(baseMVA, bus, branch)"""
+
+        self.baseMVA = baseMVA
+        self.nb = bus.shape[0]
+        self.f, self.t = branch[:, 0].astype(int), branch[:, 1].astype(int)
+        self.Ybus, self.Yf, self.Yt = makeYbus(baseMVA, bus, branch)
+        self.Ybus, self.Yf = self.Ybus.tocsr(), self.Yf.tocsr()
+        self.ref, self.pv, self.pq = find(bus[:, 1] == 3), find(bus[:, 1] == 2), find(bus[:, 1] == 1)
+        self.pvpq = np.r_[self.pv, self.pq]
+        self.Vm0 = np.ones(self.nb)  # voltage magnitude set points at gen buses
+        on = gen[:, 7] > 0
+        self.Vm0[gen[on, 0].astype(int)] = gen[on, 5]
+        self.key = case_key(baseMVA, bus, branch) if key is None else key
+        self.V = None  # last converged solution, used for warm starts
+        self.perm = None  # column ordering of the Jacobian
+
+    def flat_start(self):
+        """Flat start with voltage set points at gen buses"""
+        return self.Vm0.astype(complex)
+
+    def solve(self, Sbus, V0=None, tol=1e-8, max_it=10):
+        """Solve AC power flow for complex bus injections Sbus (pu).
+        V0: initial voltages, by default the last converged solution (flat start if none)
+        Returns voltages (complex, pu), converged (bool), number of iterations and max mismatch."""
+
+        if V0 is None:
+            V0 = self.V if self.V is not None else self.flat_start()
+        gb = np.r_[self.ref, self.pv]
+        V = np.array(V0, dtype=complex)
+        V[gb] = self.Vm0[gb] * V[gb] / np.abs(V[gb])  # keep set points at gen buses
+        Va, Vm = np.angle(V), np.abs(V)
+        npvpq = len(self.pvpq)
+
+        it = 0
+        F = self.mismatch(V, Sbus)
+        while np.linalg.norm(F, np.inf) >= tol and it < max_it:
+            it += 1
+            dS_dVm, dS_dVa = dSbus_dV(self.Ybus, V)
+            J11 = dS_dVa[self.pvpq, :][:, self.pvpq].real
+            J12 = dS_dVm[self.pvpq, :][:, self.pq].real
+            J21 = dS_dVa[self.pq, :][:, self.pvpq].imag
+            J22 = dS_dVm[self.pq, :][:, self.pq].imag
+            J = sp.vstack([sp.hstack([J11, J12]), sp.hstack([J21, J22])], format="csc")
+            dx = self.linsolve(J, -F)
+            Va[self.pvpq] += dx[:npvpq]
+            Vm[self.pq] += dx[npvpq:]
+            V = Vm * np.exp(1j * Va)
+            Vm, Va = np.abs(V), np.angle(V)
+            F = self.mismatch(V, Sbus)
+
+        mis = np.linalg.norm(F, np.inf)
+        converged = bool(mis < tol)
+        if converged:
+            self.V = V
+        return V, converged, it, mis
+
+    def mismatch(self, V, Sbus):
+        """Active power mismatch at pv and pq buses and reactive at pq buses"""
+        mis = V * np.conj(self.Ybus @ V) - Sbus
+        return np.r_[mis[self.pvpq].real, mis[self.pq].imag]
+
+    def linsolve(self, J, rhs):
+        """Solve J * x = rhs, reusing the column ordering from the first factorization"""
+        if self.perm is None:
+            lu = splu(J)
+            self.perm = np.argsort(lu.perm_c)  # J[:, perm] has the fill-reducing column order
+            return lu.solve(rhs)
+        lu = splu(J[:, self.perm], permc_spec="NATURAL")
+        x = np.empty_like(rhs)
+        x[self.perm] = lu.solve(rhs)
+        return x
+
+    def flows(self, V):
+        """Active power flow (MW) at the from end of each branch"""
+        return (V[self.f] * np.conj(self.Yf @ V)).real * self.baseMVA
+
+
+def case_key(baseMVA, bus, branch):
+    """Hash of the parts of a pypower case that determine Ybus and bus types"""
+    return topology_key([baseMVA], bus[:, [1, 4, 5]], branch[:, [0, 1, 2, 3, 4, 8, 9, 10]])
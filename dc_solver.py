@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Sparse DC power flow for the N490 model.
+
+The reduced nodal susceptance matrix B' is built once per topology and
+factorized with SuperLU, so each hour is solved with a single back-substitution
+instead of rebuilding and refactorizing the whole case with pypower rundcpf.
+
+Changes to a few branches (outages, new reactances) are applied as a low rank
+Sherman-Morrison-Woodbury update of the factorization, see DCSolver.update().
+
+Conventions follow pypower: branch susceptance b = status/x (all turns ratios
+are 1 in make_mpc), voltage angles in degrees with the reference bus at 0 and
+branch flows in MW in the direction bus0 -> bus1.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from numpy import flatnonzero as find
+from scipy.sparse.linalg import splu
+
+logger = logging.getLogger("Nordic490.dc_solver")
+
+
+def topology_key(*arrays):
+    """Hash of arrays describing a topology (bus/branch indices, reactances etc.)"""
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        if a.dtype.kind != "u":  # keep e.g. pandas hashes as uint64
+            a = a.astype(float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class DCSolver:
+    def __init__(self, nb, f, t, b, ref=0, baseMVA=100.0):
+        """Build and factorize B' for a fixed topology.
+        nb: number of buses, f/t: from/to bus index (0..nb-1) for each branch,
+        b: branch susceptance 1/x (pu), 0 for branches out of service, ref: index of reference (slack) bus"""
+
+        self.nb, self.nl = nb, len(f)
+        self.f, self.t = np.asarray(f, dtype=int), np.asarray(t, dtype=int)
+        self.b = np.asarray(b, dtype=float)
+        self.ref = ref
+        self.baseMVA = baseMVA
+        self.pvpq = find(np.arange(nb) != ref)  # non-reference buses
+        i = np.arange(self.nl)
+        self.A = sp.csr_matrix(
+            (np.r_[np.ones(self.nl), -np.ones(self.nl)], (np.r_[i, i], np.r_[self.f, self.t])),
+            shape=(self.nl, self.nb),
+        )  # +1 at bus0, -1 at bus1
+        self.key = topology_key([nb, ref, baseMVA], self.f, self.t, self.b)
+        self.factors = {}  # PTDF, LODF etc., see ptdf() and lodf()
+        self.factorize()
+
+    def factorize(self):
+        """Build Bf and Bbus for the present susceptances and factorize the reduced Bbus"""
+        self.Bf = sp.diags(self.b) @ self.A  # branch flow = Bf * Va
+        self.Bbus = (self.A.T @ self.Bf).tocsc()
+        Bred = self.Bbus[self.pvpq, :][:, self.pvpq].tocsc()
+        self.lu = splu(Bred, permc_spec="MMD_AT_PLUS_A")
+        self.b0 = self.b.copy()  # susceptances of factorized B'
+        self.mod, self.U, self.W, self.S = find(np.zeros(self.nl)), None, None, None  # low rank update
+
+    def update(self, b, max_rank=50):
+        """Change branch susceptances to b (0 for out of service) without refactorizing B'.
+        The change is applied as a Sherman-Morrison-Woodbury update of rank equal to the number
+        of branches that differ from the factorized case, if this exceeds max_rank B' is refactorized."""
+
+        b = np.asarray(b, dtype=float)
+        mod = find(b != self.b0)
+        if len(mod) > max_rank:
+            U, W, S = None, None, None
+        elif len(mod) > 0:
+            U = self.A[mod][:, self.pvpq].T.toarray()  # B' = B0' + U * diag(b - b0) * U'
+            W = self.lu.solve(U)
+            S = np.diag(1 / (b[mod] - self.b0[mod])) + U.T @ W
+            if np.linalg.cond(S) > 1e12:
+                raise ValueError("Branch update islands the network: %s" % str(mod[b[mod] == 0]))
+        else:
+            U, W, S = None, None, None
+
+        self.b = b
+        self.key = topology_key([self.nb, self.ref, self.baseMVA], self.f, self.t, self.b)
+        self.factors = {}
+        if len(mod) > max_rank:
+            logger.debug("%d branches changed, refactorizing B'" % len(mod))
+            self.factorize()
+        else:
+            self.Bf = sp.diags(self.b) @ self.A
+            self.Bbus = (self.A.T @ self.Bf).tocsc()
+            self.mod, self.U, self.W, self.S = mod, U, W, S
+
+    def solve_reduced(self, rhs):
+        """Solve B' * Va = rhs for non-reference buses, including any low rank update"""
+        y = self.lu.solve(rhs)
+        if self.W is not None:
+            y -= self.W @ np.linalg.solve(self.S, self.U.T @ y)
+        return y
+
+    def __getstate__(self):
+        """SuperLU objects can't be pickled, the factorization is redone when unpickling"""
+        state = self.__dict__.copy()
+        del state["lu"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.factorize()  # also includes any low rank update
+
+    def solve(self, P):
+        """Solve DC power flow for bus injections P (MW, generation - load).
+        P is a vector (nb) or a matrix (nb x hours). Returns voltage angles (deg)
+        and branch flows (MW) with the same number of columns."""
+
+        P = np.asarray(P, dtype=float)
+        Va = np.zeros(P.shape)
+        Va[self.pvpq] = self.solve_reduced(P[self.pvpq] / self.baseMVA)
+        Pf = self.Bf @ Va * self.baseMVA
+        return Va * 180 / np.pi, Pf
+
+    def ptdf(self, cache_dir=None):
+        """Power transfer distribution factors (branch x bus), injections balanced at the reference bus.
+        Branch flows for any hour are then ptdf @ P"""
+        if "ptdf" not in self.factors:
+            self.load_factors(cache_dir)
+        if "ptdf" not in self.factors:
+            H = np.zeros((self.nl, self.nb))
+            H[:, self.pvpq] = self.solve_reduced(self.Bf[:, self.pvpq].T.toarray()).T  # B' is symmetric
+            self.factors["ptdf"] = H
+            self.save_factors(cache_dir)
+        return self.factors["ptdf"]
+
+    def lodf(self, cache_dir=None):
+        """Line outage distribution factors (branch x branch). Column k is the change in flow
+        on each branch per MW flowing on branch k before it is taken out. Outages that island
+        the network (radial branches) give a column of nan."""
+        if "lodf" not in self.factors:
+            self.load_factors(cache_dir)
+        if "lodf" not in self.factors:
+            H = self.ptdf(cache_dir) @ self.A.T.toarray()  # flow on l from a transfer bus0(k) -> bus1(k)
+            den = 1 - np.diag(H)
+            island = np.abs(den) < 1e-9
+            den[island] = np.nan
+            L = H / den
+            np.fill_diagonal(L, -1.0)
+            L[:, island] = np.nan
+            self.factors["lodf"] = L
+            self.save_factors(cache_dir)
+        return self.factors["lodf"]
+
+    def factor_file(self, cache_dir):
+        """File with cached factors, named by the topology hash"""
+        return os.path.join(cache_dir, "dc_factors_%s.npz" % self.key)
+
+    def load_factors(self, cache_dir):
+        """Load factors for this topology from cache_dir (if saved before)"""
+        if cache_dir is None or not os.path.exists(self.factor_file(cache_dir)):
+            return
+        with np.load(self.factor_file(cache_dir)) as data:
+            for k in data.files:
+                self.factors.setdefault(k, data[k])
+        logger.debug("Loaded DC factors from %s" % self.factor_file(cache_dir))
+
+    def save_factors(self, cache_dir):
+        """Save computed factors to cache_dir (written to a temporary file first)"""
+        if cache_dir is None:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = self.factor_file(cache_dir) + ".tmp.npz"
+        np.savez_compressed(tmp, **self.factors)
+        os.replace(tmp, self.factor_file(cache_dir))
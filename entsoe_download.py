@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""HTTP download engine for the ENTSO-E transparency API.
+
+Requests go through keep-alive sessions (one per worker thread) and a shared
+rate limit, so that the API quota (400 requests/minute) is respected also with
+many workers. Connection errors, 429 and 5xx responses are retried with
+exponential backoff. Downloads are split in chunks (e.g. one area and day)
+that are run in a thread pool; completed chunks are logged in the table
+download_log in the same transaction as their data, so an interrupted
+backfill can be resumed.
+
+The url can be changed, e.g. to test against a local mock server.
+
+Responses can be kept in an on-disk cache (ResponseCache), so that a backfill
+can be re-run, e.g. after a parser or schema change, without requests to the
+API. Responses for periods that ended more than settle days ago never expire,
+more recent ones (which may still be updated) expire after ttl seconds.
+"""
+
+import datetime
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("Nordic490.entsoe_download")
+
+url = "https://transparency.entsoe.eu/api"
+token = "a954a1fe-a63e-4c55-84a8-425c35484edb"
+
+# response read from cache, has the attributes of requests.Response used by get_entsoe_gen_data
+CachedResponse = namedtuple("CachedResponse", ["status_code", "content"])
+
+
+class Downloader:
+    def __init__(self, workers=4, rate=6.0, retries=4, backoff=2.0, timeout=60, url=url, token=token, cache=None):
+        """workers: number of concurrent requests, rate: max requests per second (all workers)
+        retries: number of retries after failed requests, backoff: wait before first retry (s), doubled each time
+        timeout: connect/read timeout (s)
+        cache: ResponseCache or cache folder, None -> no caching"""
+
+        self.workers = workers
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.url = url
+        self.token = token
+        self.cache = ResponseCache(cache) if isinstance(cache, str) else cache
+        self.lock = threading.Lock()
+        self.next_time = 0.0  # earliest time for next request
+        self.local = threading.local()  # session for each thread
+
+    def session(self):
+        """Keep-alive session for the calling thread"""
+        if not hasattr(self.local, "session"):
+            s = requests.Session()
+            s.mount("https://", HTTPAdapter(pool_maxsize=1))
+            s.mount("http://", HTTPAdapter(pool_maxsize=1))
+            self.local.session = s
+        return self.local.session
+
+    def wait(self):
+        """Block until a request is allowed by the rate limit"""
+        with self.lock:
+            now = time.monotonic()
+            t = max(now, self.next_time)
+            self.next_time = t + 1.0 / self.rate
+        if t > now:
+            time.sleep(t - now)
+
+    def get(self, params):
+        """GET request with query parameters params (security token added). Connection errors,
+        429 and 5xx responses are retried. Returns the last response, None if there was none.
+        With a cache, successful responses are stored and returned without a request while valid."""
+
+        if self.cache is not None:
+            content = self.cache.get(params)
+            if content is not None:
+                return CachedResponse(requests.codes.ok, content)
+            r = self.request(params)
+            if r is not None and r.status_code == requests.codes.ok:
+                self.cache.put(params, r.content)
+            return r
+        return self.request(params)
+
+    def request(self, params):
+        """GET request with retries, see get()"""
+        params = dict(params, securityToken=self.token)
+        r = None
+        for attempt in range(self.retries + 1):
+            self.wait()
+            delay = self.backoff * 2**attempt
+            try:
+                r = self.session().get(self.url, params=params, timeout=self.timeout)
+            except requests.RequestException as err:
+                logger.info("Request failed ({0}): {1}".format(attempt + 1, err))
+                r = None
+            else:
+                if r.status_code != 429 and r.status_code < 500:
+                    return r
+                logger.info("Request failed ({0}): HTTP {1}".format(attempt + 1, r.status_code))
+                try:
+                    delay = max(delay, float(r.headers.get("Retry-After", 0)))
+                except ValueError:
+                    pass
+            if attempt < self.retries:
+                time.sleep(delay)
+        return r
+
+    def run(self, func, tasks):
+        """Call func(task) for each task in worker threads.
+        Yields (task, result) in order of completion, exceptions in func are raised.
+        At most 2 * workers tasks are submitted at a time, so that results are not kept
+        in memory for the whole download."""
+
+        pool = ThreadPoolExecutor(self.workers)
+        tasks = iter(tasks)
+        futures = {}
+        try:
+            while True:
+                for task in tasks:
+                    futures[pool.submit(func, task)] = task
+                    if len(futures) >= 2 * self.workers:
+                        break
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    task = futures.pop(f)
+                    yield task, f.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class ResponseCache:
+    def __init__(self, root="Data/entsoe_cache", ttl=3600, settle=7):
+        """Cache with compressed responses in folder root, one file per request.
+        Responses for requests with periodEnd more than settle days ago never expire,
+        other responses expire ttl seconds after they were stored."""
+        self.root = root
+        self.ttl = ttl
+        self.settle = settle
+
+    def key(self, params):
+        """Hash of normalized query parameters (sorted, security token excluded)"""
+        items = sorted((k, str(v).strip()) for k, v in params.items() if k != "securityToken")
+        return hashlib.sha256("&".join("{0}={1}".format(k, v) for k, v in items).encode()).hexdigest()
+
+    def path(self, params):
+        key = self.key(params)
+        return os.path.join(self.root, key[:2], key + ".xml.gz")
+
+    def historical(self, params):
+        """True if the requested period ended more than settle days ago"""
+        try:
+            end = datetime.datetime.strptime(params["periodEnd"], "%Y%m%d%H%M")
+        except (KeyError, ValueError):
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return end < now - datetime.timedelta(days=self.settle)
+
+    def get(self, params):
+        """Cached response content for params, None if not cached or expired"""
+        path = self.path(params)
+        try:
+            if not self.historical(params) and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                return gzip.decompress(f.read())
+        except (OSError, EOFError):  # not cached or incomplete file
+            return None
+
+    def put(self, params, content):
+        """Store response content for params"""
+        path = self.path(params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(gzip.compress(content))
+        os.replace(tmp, path)  # atomic, concurrent readers see the old or the new file
+
+
+default = None
+
+
+def default_downloader():
+    """Shared downloader for single requests (get_entsoe_gen_data without downloader)"""
+    global default
+    if default is None:
+        default = Downloader(workers=1)
+    return default
+
+
+def init_log(conn):
+    """Create table download_log with completed chunks if it doesn't exist"""
+    conn.execute("CREATE TABLE IF NOT EXISTS download_log (task TEXT PRIMARY KEY)")
+
+
+def done_tasks(conn, prefix):
+    """Completed chunks with names starting with prefix"""
+    init_log(conn)
+    rows = conn.execute("SELECT task FROM download_log WHERE task >= ? AND task < ?", (prefix, prefix + "\uffff"))
+    return set(row[0] for row in rows)
+
+
+def mark_done(conn, task):
+    """Log chunk as completed, call inside the transaction inserting its data"""
+    conn.execute("INSERT OR IGNORE INTO download_log (task) VALUES (?)", (task,))
@@ -43,8 +43,8 @@ Created on Wed Jan 16 11:31:07 2019
 # from nordic490 import N490
 
 import datetime
+import io
 import logging
-import sqlite3
 from pathlib import Path
 
 # import json
@@ -56,7 +56,9 @@ import pandas as pd
 import requests
 from prettytable import PrettyTable
 
-from help_functions import intersection, str_to_date
+import parquet_store
+from entsoe_download import Downloader, default_downloader, done_tasks, init_log, mark_done
+from help_functions import DatabaseConnection, connect_db, group_matrix, intersection, str_to_date, time2int
 
 logger = logging.getLogger("Nordic490.entsoe_transparency_db")
 
@@ -164,6 +166,14 @@ se_aggr_types = {
     "Wind": ["Wind"],
     "Thermal": ["CHP", "Gas"],
 }
+# SvK production types used in select_gen_per_type_array, renamed as the aggregates for ENTSO-E types
+se_entsoe_types = {
+    "Hydro": "Hydro",
+    "CHP": "Thermal",
+    "Solar": "Solar",
+    "Nuclear": "Nuclear",
+    "Wind": "Wind",
+}
 area_codes = ["SE1", "SE2", "SE3", "SE4", "DK1", "DK2", "EE", "LT", "LV", "FI", "NO1", "NO2", "NO3", "NO4", "NO5"]
 
 area_codes_idx = {}
@@ -195,7 +205,7 @@ se_types = {
 #        }
 
 
-class DatabaseGenUnit:
+class DatabaseGenUnit(DatabaseConnection):
     """Class for database with generation per unit. Due to the different structure of this database
     it is a separate class."""
 
@@ -206,15 +216,23 @@ class DatabaseGenUnit:
             pass
 
     def download_data(
-        self, starttime="20160101", endtime="20160110", countries=["SE", "NO", "DK", "FI", "LT", "LV", "EE"]
+        self,
+        starttime="20160101",
+        endtime="20160110",
+        countries=["SE", "NO", "DK", "FI", "LT", "LV", "EE"],
+        resume=True,
+        downloader=None,
     ):
         """Download ENTSO-E data to database. Will not overwrite any data already present
         in the database, either in TABLE units or TABLE CC_YYYYMM, thus this function can be
-        called multiple times to extend database. Time for download is approximately 40 min/month if
-        all countries are included"""
+        called multiple times to extend database. Data tables have a unique (id,time) index and the
+        data for each country and day is inserted in one transaction.
+
+        The days are downloaded concurrently with downloader (entsoe_download.Downloader, by default
+        4 workers). Completed days are logged in table download_log and skipped if resume=True."""
 
         # make sqlite database
-        conn = sqlite3.connect(self.db)
+        conn = connect_db(self.db)
         c = conn.cursor()
 
         # check if units table exists, if not create it
@@ -233,75 +251,75 @@ class DatabaseGenUnit:
             )
             conn.commit()
 
-        days = pd.date_range(start=str_to_date(starttime), end=str_to_date(endtime), freq="D")
-
-        # get data
-        for day in days:
-            if day.day == 1:
-                logger.info("------------------------")
-                logger.info("Fetching data for {0}".format(day.strftime("%Y%m")))
-                logger.info("------------------------")
-            for country in countries:
-                ## data table ##
-                # name of table
-                table = country + "_" + day.strftime("%Y%m")
-
-                # check if table exists, if not create table
-                c.execute("SELECT name FROM sqlite_master WHERE type ='table' AND name='{0}'".format(table))
-                if c.fetchone() is None:
-                    # add table
-                    c.execute("CREATE TABLE {0} (id TEXT NOT NULL,time TEXT NOT NULL,MWh FLOAT NOT NULL)".format(table))
-
-                ## units table ##
-                # get all units in table
-                c.execute("SELECT id FROM units")
-                unit_list = []
-                for unit in c:
-                    unit_list.append(unit[0])
-
-                data = get_entsoe_gen_data(
-                    datatype=4, area=country, start=day.strftime("%Y%m%d"), end=day.strftime("%Y%m%d")
-                )
-                if data is not None:
-                    for unit in data:
-                        ## data table ##
-                        for row in unit["Period"].items():
-                            # check if data already exists
-                            c.execute(
-                                "SELECT count(*) FROM {0} WHERE id = '{1}' AND time = '{2}'".format(
-                                    table, unit["id"], row[0].strftime("%Y%m%d:%H")
-                                )
-                            )
-                            if c.fetchone()[0] == 0:
-                                c.execute(
-                                    "INSERT INTO {0}(id,time,MWh) values ('{1}','{2}',{3})".format(
-                                        table, unit["id"], row[0].strftime("%Y%m%d:%H"), row[1]
-                                    )
-                                )
-
-                        ## units table ##
-                        if unit["id"] not in unit_list:
-                            # add unit to table
-                            c.execute(
-                                "INSERT INTO units(id,name,country,type,resource) values ('{0}','{1}','{2}','{3}','{4}')".format(
-                                    unit["id"],
-                                    unit["name"],
-                                    country,
-                                    unit["production_type"],
-                                    unit["registeredResource.mRID"],
-                                )
+        # all units in table
+        c.execute("SELECT id FROM units")
+        units = set(row[0] for row in c)
+
+        days = pd.date_range(start=str_to_date(starttime), end=str_to_date(endtime), freq="D").strftime("%Y%m%d")
+        done = done_tasks(conn, "gen_per_unit:") if resume else set()
+        tasks = [
+            (country, day)
+            for day in days
+            for country in countries
+            if "gen_per_unit:{0}:{1}".format(country, day) not in done
+        ]
+        ndone = len(days) * len(countries) - len(tasks)
+        logger.info("Downloading {0} days of unit data ({1} already done)".format(len(tasks), ndone))
+
+        downloader = downloader or Downloader()
+
+        def fetch(task):
+            return get_entsoe_gen_data(datatype=4, area=task[0], start=task[1], end=task[1], downloader=downloader)
+
+        # get data, written to database as each day is completed
+        for counter, ((country, day), data) in enumerate(downloader.run(fetch, tasks)):
+            ## data table ##
+            # name of table
+            table = country + "_" + day[:6]
+
+            if data is not None:
+                rows = []
+                new_units = []
+                for unit in data:
+                    ## data table ##
+                    period = hourly(unit["Period"]).dropna()
+                    times = period.index.strftime("%Y%m%d:%H")
+                    rows += [(unit["id"], time, val) for time, val in zip(times, period.values.tolist())]
+
+                    ## units table ##
+                    if unit["id"] not in units:
+                        units.add(unit["id"])
+                        new_units.append(
+                            (
+                                unit["id"],
+                                unit["name"],
+                                country,
+                                unit["production_type"],
+                                unit["registeredResource.mRID"],
                             )
-                    conn.commit()
-                else:
-                    logger.info("No data for {0} for {1}".format(country, day.strftime("%Y%m%d")))
+                        )
+                # create table if it doesn't exist, existing data is not overwritten
+                c.execute(
+                    "CREATE TABLE IF NOT EXISTS {0} ".format(table)
+                    + "(id TEXT NOT NULL,time TEXT NOT NULL,MWh FLOAT NOT NULL)"
+                )
+                c.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_id_time ON {0} (id,time)".format(table))
+                with conn:  # one transaction per country and day
+                    c.executemany("INSERT OR IGNORE INTO {0}(id,time,MWh) VALUES (?,?,?)".format(table), rows)
+                    c.executemany("INSERT INTO units(id,name,country,type,resource) VALUES (?,?,?,?,?)", new_units)
+                    mark_done(conn, "gen_per_unit:{0}:{1}".format(country, day))
+            else:
+                logger.info("No data for {0} for {1}".format(country, day))
+            if counter % 100 == 0:
+                logger.info("Progress: {0:.1f}%".format(counter / len(tasks) * 100))
+        conn.close()
 
     def select_data(self, start="20160101", end="20160301", countries=["SE", "NO", "FI", "DK", "EE", "LT", "LV"]):
         starttime = start + ":00"
         endtime = end + ":23"
 
         # connect to database
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
+        c = self.connect().cursor()
 
         # get list of all tables
         c.execute("SELECT name FROM sqlite_master WHERE type ='table'")
@@ -336,20 +354,23 @@ class DatabaseGenUnit:
         return df, df2
 
 
-class Database:
-    def __init__(self, db="Data/entsoe_transparency.db"):
+class Database(DatabaseConnection):
+    def __init__(self, db="Data/entsoe_transparency.db", parquet=None):
+        """parquet: root of Parquet store (see parquet_store), tables exported there are read from it"""
         self.db = db
+        self.parquet = parquet
 
         if Path(self.db).exists():
             pass
 
-    def download_cap_per_type_data(self, start_year=2015, end_year=2018, areas=[]):
+    def download_cap_per_type_data(self, start_year=2015, end_year=2018, areas=[], downloader=None):
         """
         Download capacities per production type and store in sqlite database,
-        in table cap_per_type
+        in table cap_per_type. The areas and years are downloaded concurrently with
+        downloader (entsoe_download.Downloader, by default 4 workers).
         """
         # make sqlite database
-        conn = sqlite3.connect(self.db)
+        conn = connect_db(self.db)
         # logger.info(sqlite3.version)
         c = conn.cursor()
 
@@ -363,27 +384,26 @@ class Database:
             + ")"
         )
 
-        # download data for each year and price area
-        for year in range(start_year, end_year):
-            for area in area_codes:
-                data = get_entsoe_gen_data(
-                    datatype=1, area=area, start="{0}0101".format(year), end="{0}0101".format(year)
-                )
+        downloader = downloader or Downloader()
+        tasks = [(area, year) for year in range(start_year, end_year) for area in areas or area_codes]
 
-                if data is not None:
-                    logger.info("Fetched data for {0} for {1}".format(area, year))
-                    # collect data
-                    for point in data:
-                        # acode = point['inBiddingZone_Domain.mRID']
-                        gentype = tpsr_rkey[point["MktPSRType"]]
-                        cmd = "INSERT INTO cap_per_type (year,type,area,cap) VALUES ('{0}','{1}','{2}',{3})".format(
-                            year, gentype, area, point["Period"][0]
-                        )
-                        c.execute(cmd)
-                        # self.areas[tbidz_rkey[acode]].gen_cap[tpsr_rabbrv[gcode]][year] = point['Period'][0]
-                        # insert data into database
-                else:
-                    logger.info("Data collection failed for {0} for {1}".format(area, year))
+        def fetch(task):
+            start = "{0}0101".format(task[1])
+            return get_entsoe_gen_data(datatype=1, area=task[0], start=start, end=start, downloader=downloader)
+
+        # download data for each year and price area
+        for (area, year), data in downloader.run(fetch, tasks):
+            if data is not None:
+                logger.info("Fetched data for {0} for {1}".format(area, year))
+                # collect data
+                rows = []
+                for point in data:
+                    # acode = point['inBiddingZone_Domain.mRID']
+                    gentype = tpsr_rkey[point["MktPSRType"]]
+                    rows.append((str(year), gentype, area, float(point["Period"].iloc[0])))
+                c.executemany("INSERT INTO cap_per_type (year,type,area,cap) VALUES (?,?,?,?)", rows)
+            else:
+                logger.info("Data collection failed for {0} for {1}".format(area, year))
 
         conn.commit()
         conn.close()
@@ -395,10 +415,8 @@ class Database:
             gdata - dict with panda dataframe for each area
         """
 
-        # make sqlite database
-        conn = sqlite3.connect(self.db)
-        # logger.info(sqlite3.version)
-        c = conn.cursor()
+        # connect to database
+        c = self.connect().cursor()
 
         cmd_min = "SELECT min(year) FROM cap_per_type"
         cmd_max = "SELECT max(year) FROM cap_per_type"
@@ -430,39 +448,55 @@ class Database:
         for row in c:
             gdata[row[1]][row[2]][int(row[0])] = row[3]
 
-        conn.close()
-
         for area in gdata:
             fillna(gdata[area])
 
         return gdata
 
-    def download_gen_per_type_data(self, start_year=2015, end_year=2018, areas=[]):
+    def download_gen_per_type_data(self, start_year=2015, end_year=2018, areas=[], resume=False, downloader=None):
         """Download actual generation by production type for all bidding areas.
         The data is saved to the table "gen_per_type" in the given database:
 
-        TABLE gen_per_type(TEXT time,TEXT type,TEXT area,REAL gen)
+        TABLE gen_per_type(TEXT time,TEXT type,TEXT area,REAL gen), unique (time,type,area)
 
-        time has format 'YYYYMMDD:HH'
+        time has format 'YYYYMMDD:HH'. The data for each area and day is inserted in one transaction.
+
+        The days are downloaded concurrently with downloader (entsoe_download.Downloader, by default
+        4 workers). Completed days are logged in table download_log. With resume=False the table is
+        recreated, with resume=True it is kept and only days not yet completed are downloaded, so that
+        an interrupted download can be continued.
 
         Note that some areas lacks data, such as SE1 which only has data on production
         for onshore wind.
         """
 
         # make sqlite database
-        conn = sqlite3.connect(self.db)
+        conn = connect_db(self.db)
         # logger.info(sqlite3.version)
         c = conn.cursor()
 
-        c.execute("DROP TABLE IF EXISTS gen_per_type")
+        if not resume:
+            c.execute("DROP TABLE IF EXISTS gen_per_type")
+            init_log(conn)
+            c.execute("DELETE FROM download_log WHERE task LIKE 'gen_per_type:%'")
+            conn.commit()
         c.execute(
-            "CREATE TABLE gen_per_type ("
+            "CREATE TABLE IF NOT EXISTS gen_per_type ("
             + "time TEXT NOT NULL,"
             + "type TEXT NOT NULL,"
             + "area TEXT NOT NULL,"
-            + "gen REAL"
+            + "gen REAL,"
+            + "UNIQUE (time,type,area)"
             + ")"
         )
+        if not any(idx[2] for idx in c.execute("PRAGMA index_list(gen_per_type)").fetchall()):
+            # table created without unique key: remove duplicates (last kept, as in select) and add key
+            with conn:
+                c.execute(
+                    "DELETE FROM gen_per_type WHERE rowid NOT IN "
+                    "(SELECT max(rowid) FROM gen_per_type GROUP BY time,type,area)"
+                )
+                c.execute("CREATE UNIQUE INDEX IF NOT EXISTS gen_per_type_key ON gen_per_type (time,type,area)")
 
         if areas == []:
             areas = [
@@ -483,44 +517,36 @@ class Database:
                 "NO5",
             ]
 
-        nfiles = areas.__len__() * (start_year - end_year + 1) * 365
-
-        logger.info("Downloading data from entsoe transparency: ")
-        for area in areas:
-            # iterate over time
-            date = datetime.datetime(start_year, 1, 1)
-            counter = 0
-            while date.year <= end_year:
-                # retrieve data
-                sdate = date.strftime("%Y%m%d")
-                # logger.info(sdate)
-                # get data for one day
-                data = get_entsoe_gen_data(datatype=3, area=area, start=sdate, end=sdate, file=None)
-
-                if data is not None:
-                    for point in data:
-                        gtype = point["production_type"]
-                        # area = tbidz_rkey[point['inBiddingZone_Domain.mRID']]
-                        for row in point["Period"].items():
-                            time = row[0].strftime("%Y%m%d:%H")
-                            val = str(row[1])
-                            try:  # insert row into table
-                                cmd = 'INSERT INTO gen_per_type (time,type,area,gen) values("{0}","{1}","{2}",{3})'.format(
-                                    time, gtype, area, val
-                                )
-                                # logger.info(cmd)
-                                c.execute(cmd)
-                            except sqlite3.Error as err:
-                                logger.info(err)
-                                logger.info("Area: " + area + ", type: " + gtype + ", time: " + time)
-                else:
-                    logger.info("Data collection failed for {0} for {1}".format(area, sdate))
-                    # increment
-                date = date + datetime.timedelta(days=1)
-                if np.remainder(counter, 10) == 0:
-                    logger.info("Progress: {0}%".format(str(counter / nfiles * 100)[:4]))
-                counter += 1
-        conn.commit()
+        days = pd.date_range(
+            start=datetime.datetime(start_year, 1, 1), end=datetime.datetime(end_year, 12, 31), freq="D"
+        )
+        days = days.strftime("%Y%m%d")
+        done = done_tasks(conn, "gen_per_type:")
+        tasks = [(area, day) for area in areas for day in days if "gen_per_type:{0}:{1}".format(area, day) not in done]
+        nfiles = len(tasks)
+
+        downloader = downloader or Downloader()
+
+        def fetch(task):
+            # get data for one day
+            return get_entsoe_gen_data(datatype=3, area=task[0], start=task[1], end=task[1], downloader=downloader)
+
+        logger.info("Downloading data from entsoe transparency: {0} days ({1} already done)".format(nfiles, len(done)))
+        for counter, ((area, sdate), data) in enumerate(downloader.run(fetch, tasks)):
+            if data is not None:
+                rows = []
+                for point in data:
+                    gtype = point["production_type"]
+                    period = hourly(point["Period"]).dropna()
+                    times = period.index.strftime("%Y%m%d:%H")
+                    rows += [(time, gtype, area, val) for time, val in zip(times, period.values.tolist())]
+                with conn:  # one transaction per area and day
+                    c.executemany("INSERT OR IGNORE INTO gen_per_type (time,type,area,gen) VALUES (?,?,?,?)", rows)
+                    mark_done(conn, "gen_per_type:{0}:{1}".format(area, sdate))
+            else:
+                logger.info("Data collection failed for {0} for {1}".format(area, sdate))
+            if np.remainder(counter, 10) == 0:
+                logger.info("Progress: {0}%".format(str(counter / nfiles * 100)[:4]))
         conn.close()
 
     def select_gen_per_type_data(self, areas=[], types=[], starttime="", endtime="", excelfile=None):
@@ -540,9 +566,6 @@ class Database:
 
         """
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
         if areas != []:
             str_areas = "("
             for idx, area in enumerate(areas):
@@ -562,9 +585,6 @@ class Database:
             str_types += ")"
 
         cmd = "SELECT gen,time,type,area FROM gen_per_type"
-        # Note: Two additional querys are used to find the starting and ending date
-        cmd_max = "SELECT max(time) FROM gen_per_type"
-        cmd_min = "SELECT min(time) FROM gen_per_type"
 
         conditions = []
         if areas != []:
@@ -583,95 +603,34 @@ class Database:
         n = conditions.__len__()
         if n > 0:
             cmd += " WHERE "
-            cmd_max += " WHERE "
-            cmd_min += " WHERE "
             for idx, cnd in enumerate(conditions):
                 if idx > 0:
                     cmd += " AND "
-                    cmd_max += " AND "
-                    cmd_min += " AND "
                 if cnd == "area":
                     cmd += area_cnd
-                    cmd_max += area_cnd
-                    cmd_min += area_cnd
                 elif cnd == "type":
                     cmd += type_cnd
-                    cmd_max += type_cnd
-                    cmd_min += type_cnd
                 elif cnd == "start":
                     cmd += start_cnd
-                    cmd_max += start_cnd
-                    cmd_min += start_cnd
                 elif cnd == "end":
                     cmd += end_cnd
-                    cmd_max += end_cnd
-                    cmd_min += end_cnd
                 else:
-                    logger.info("Unknown condition type: {0}".format(c))
+                    logger.info("Unknown condition type: {0}".format(cnd))
 
-        # logger.info(cmd_min)
-        c.execute(cmd_min)
-        for row in c:
-            start = row[0]
-        c.execute(cmd_max)
-        for row in c:
-            end = row[0]
-        if start is None:
+        # get data, time index from the first to the last time in the result
+        data = self.read_rows("gen_per_type", cmd, areas, types, starttime, endtime)
+        if len(data) == 0:
             logger.info("The following command returned no data: {0}".format(cmd))
             return None
 
-        # create index for data frame
-        sdate = datetime.datetime(int(start[0:4]), int(start[4:6]), int(start[6:8]), int(start[9:11]))
-        edate = datetime.datetime(int(end[0:4]), int(end[4:6]), int(end[6:8]), int(end[9:11]))
-
-        dates = pd.date_range(start=sdate, end=edate, freq="h")
-
         # find columns for data frame
         if areas == []:  # all areas selected by default
             areas = area_codes
         if types == []:
             types = list(tpsr_abbrv.keys())
-        # create header for each combination of area and type
-        #    cols = []
-        #    for area in areas:
-        #        for gtype in types:
-        #            cols.append(area + ':' + gtype)
-
-        # allocate panda data frame for each area
-        gdata = {}
-        for area in areas:
-            gdata[area] = pd.DataFrame(dtype=float, index=dates, columns=types)
-
-        #    # allocate panda data frame for data
-        #    pd_data = pd.DataFrame( \
-        #                dtype = float, \
-        #                index=dates, \
-        #                columns=cols)
-
-        # get data
-        c.execute(cmd)  # SELECT gen,time,type,area FROM gen_per_type
-        for row in c:
-            date = datetime.datetime(int(row[1][0:4]), int(row[1][4:6]), int(row[1][6:8]), int(row[1][9:11]))
-            # pd_data[row[3] + ':' + row[2]][date] = row[0]
-            gdata[row[3]].loc[date, row[2]] = row[0]
 
-        conn.close()
-
-        # remove all columns which are NaN
-        #    isnan = pd_data.isnull().sum()
-        #    dropcols = []
-        #    for row in isnan.items():
-        #        if row[1] == pd_data.__len__():
-        #            dropcols.append(row[0])
-        #    pd_data = pd_data.drop(columns=dropcols)
-
-        for area in areas:
-            isnan = gdata[area].isnull().sum()
-            dropcols = []
-            for row in isnan.items():
-                if row[1] == gdata[area].__len__():
-                    dropcols.append(row[0])
-            gdata[area] = gdata[area].drop(columns=dropcols)
+        # one data frame for each area, columns with only NaN are removed
+        gdata = pivot_gen_data(data, areas, types)
 
         if excelfile is not None:
             writer = pd.ExcelWriter(excelfile)
@@ -682,6 +641,27 @@ class Database:
 
         return gdata
 
+    def read_rows(self, table, cmd, areas=[], types=[], starttime="", endtime=""):
+        """Rows (gen, time, type, area) selected by the sql command cmd, or the same rows
+        from the Parquet store if the table has been exported there"""
+        if self.parquet is None or not parquet_store.has_table(self.parquet, table):
+            return pd.read_sql_query(cmd, self.connect())
+        filters = []
+        if areas != []:
+            filters.append(("area", "in", areas))
+        if types != []:
+            filters.append(("type", "in", types))
+        data = parquet_store.read(
+            self.parquet,
+            table,
+            columns=["gen", "time", "type", "area"],
+            filters=filters,
+            start=time2int(starttime) if starttime != "" else None,
+            end=time2int(endtime) if endtime != "" else None,
+        )
+        data["time"] = parquet_store.time2str(data.time)
+        return data
+
     def get_se_gen_data(self):
         """
         Enter SvK generation data per type into separate table:
@@ -699,7 +679,7 @@ class Database:
         import xlrd
 
         # connect to sqlite database
-        conn = sqlite3.connect(self.db)
+        conn = connect_db(self.db)
         c = conn.cursor()
 
         # create separeate table for SE data
@@ -764,6 +744,7 @@ class Database:
                     col_idxs.append(idx)
                     col_names.append("Gas")
 
+            rows = []
             ridx = 0
             for row in ws.get_rows():
                 if ridx >= 5:
@@ -790,15 +771,12 @@ class Database:
                         gtype = se_types[col_names[nidx]]
                         data = row[cidx].value
                         if type(data) is not float:
-                            data = "NULL"
-                        cmd = "INSERT INTO se_gen_per_type (time,type,area,gen) VALUES ('{0}','{1}','{2}',{3})".format(
-                            timestr, gtype, area, data
-                        )
-                        # logger.info(cmd)
-                        c.execute(cmd)
+                            data = None
+                        rows.append((timestr, gtype, area, data))
                 ridx += 1
+            with conn:  # one transaction per file
+                c.executemany("INSERT INTO se_gen_per_type (time,type,area,gen) VALUES (?,?,?,?)", rows)
 
-        conn.commit()
         conn.close()
 
     def select_se_gen_per_type_data(self, areas=[], types=[], starttime="", endtime="", excelfile=None):
@@ -817,9 +795,6 @@ class Database:
 
         """
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
         if areas != []:
             str_areas = "("
             for idx, area in enumerate(areas):
@@ -839,9 +814,6 @@ class Database:
             str_types += ")"
 
         cmd = "SELECT gen,time,type,area FROM se_gen_per_type"
-        # Note: Two additional querys are used to find the starting and ending date
-        cmd_max = "SELECT max(time) FROM se_gen_per_type"
-        cmd_min = "SELECT min(time) FROM se_gen_per_type"
 
         conditions = []
         if areas != []:
@@ -860,75 +832,34 @@ class Database:
         n = conditions.__len__()
         if n > 0:
             cmd += " WHERE "
-            cmd_max += " WHERE "
-            cmd_min += " WHERE "
             for idx, cnd in enumerate(conditions):
                 if idx > 0:
                     cmd += " AND "
-                    cmd_max += " AND "
-                    cmd_min += " AND "
                 if cnd == "area":
                     cmd += area_cnd
-                    cmd_max += area_cnd
-                    cmd_min += area_cnd
                 elif cnd == "type":
                     cmd += type_cnd
-                    cmd_max += type_cnd
-                    cmd_min += type_cnd
                 elif cnd == "start":
                     cmd += start_cnd
-                    cmd_max += start_cnd
-                    cmd_min += start_cnd
                 elif cnd == "end":
                     cmd += end_cnd
-                    cmd_max += end_cnd
-                    cmd_min += end_cnd
                 else:
-                    logger.info("Unknown condition type: {0}".format(c))
+                    logger.info("Unknown condition type: {0}".format(cnd))
 
-        # logger.info(cmd_min)
-        c.execute(cmd_min)
-        for row in c:
-            start = row[0]
-        c.execute(cmd_max)
-        for row in c:
-            end = row[0]
-        if start is None:
+        # get data, time index from the first to the last time in the result
+        data = self.read_rows("se_gen_per_type", cmd, areas, types, starttime, endtime)
+        if len(data) == 0:
             logger.info("The following command returned no data: {0}".format(cmd))
             return None
 
-        # create index for data frame
-        sdate = datetime.datetime(int(start[0:4]), int(start[4:6]), int(start[6:8]), int(start[9:11]))
-        edate = datetime.datetime(int(end[0:4]), int(end[4:6]), int(end[6:8]), int(end[9:11]))
-
-        dates = pd.date_range(start=sdate, end=edate, freq="h")
-
         # find columns for data frame
         if areas == []:  # all areas selected by default
             areas = ["SE1", "SE2", "SE3", "SE4"]
         if types == []:
             types = [se_types[f] for f in se_types]
 
-        # allocate panda data frame for each area
-        gdata = {}
-        for area in areas:
-            gdata[area] = pd.DataFrame(dtype=float, index=dates, columns=types)
-
-        # get data
-        c.execute(cmd)  # SELECT gen,time,type,area FROM gen_per_type
-        for row in c:
-            date = datetime.datetime(int(row[1][0:4]), int(row[1][4:6]), int(row[1][6:8]), int(row[1][9:11]))
-            gdata[row[3]].loc[date, row[2]] = row[0]
-
-        conn.close()
-
-        for area in areas:
-            isnan = gdata[area].isnull().sum()
-            dropcols = []
-            for row in isnan.items():
-                if row[1] == gdata[area].__len__():
-                    dropcols.append(row[0])
-            gdata[area] = gdata[area].drop(columns=dropcols)
+        # one data frame for each area, columns with only NaN are removed
+        gdata = pivot_gen_data(data, areas, types)
 
         if excelfile is not None:
             writer = pd.ExcelWriter(excelfile)
@@ -972,7 +903,7 @@ class Database:
         #                if cols != []:
         #                    adata[area].loc[:,gtype] = se_data[area].loc[:,cols].sum(axis=1)
         #
-        pd_data = self.select_gen_per_type_wrap(starttime=starttime, endtime=endtime, thermal=thermal)
+        pd_data = self.select_gen_per_type_wrap(starttime=starttime, endtime=endtime, thermal=thermal, aggregate=True)
         adata = {}
         for area in pd_data:
             adata[area] = pd_data[area].drop(
@@ -998,6 +929,63 @@ class Database:
 
         return stats
 
+    def select_gen_per_type_array(self, starttime="20180101:00", endtime="20180107:23", areas=area_codes):
+        """Select generation per type from ENTSO-E for non-SE regions and from SvK for SE regions
+        as one array. ENTSO-E data (UTC) is time-displaced one hour to fix time lag.
+
+        Input:
+            starttime - string with starting date in format "YYYYMMDD:HH" (UTC+1)
+            endtime - string with ending date in format "YYYYMMDD:HH" (UTC+1)
+            areas - list of areas
+
+        Output:
+            time - hourly index from starttime to endtime
+            types - production types with data, SvK types renamed according to se_entsoe_types
+            values - array (time x area x type), nan for missing values
+        """
+        cmd = "SELECT gen,time,type,area FROM {0} WHERE area in ('{1}') AND time >= '{2}' AND time <= '{3}'"
+        shift = datetime.timedelta(hours=1)  # UTC -> UTC+1
+        start, end = str_to_date(starttime), str_to_date(endtime)
+
+        # ENTSO-E rows for times shifted one hour back, SvK rows in UTC+1
+        data, offset = [], []
+        ent_areas = [a for a in areas if "SE" not in a]
+        if ent_areas != []:
+            t0, t1 = (start - shift).strftime("%Y%m%d:%H"), (end - shift).strftime("%Y%m%d:%H")
+            rows = self.read_rows(
+                "gen_per_type", cmd.format("gen_per_type", "','".join(ent_areas), t0, t1), ent_areas, [], t0, t1
+            )
+            data.append(rows)
+            offset.append(np.ones(len(rows), dtype=int))
+        se_areas = [a for a in areas if "SE" in a]
+        if se_areas != []:
+            se = list(se_entsoe_types)
+            se_cmd = cmd.format("se_gen_per_type", "','".join(se_areas), starttime, endtime)
+            se_cmd += " AND type in ('{0}')".format("','".join(se))
+            rows = self.read_rows("se_gen_per_type", se_cmd, se_areas, se, starttime, endtime)
+            rows["type"] = rows.type.map(se_entsoe_types)
+            data.append(rows)
+            offset.append(np.zeros(len(rows), dtype=int))
+        data = pd.concat(data, ignore_index=True)
+        offset = np.concatenate(offset).astype("timedelta64[h]")  # hours added to the times
+
+        time = pd.date_range(start=start, end=end, freq="h")
+        tcode, tcats = pd.factorize(data.time.values)  # each time parsed once
+        times = pd.to_datetime(tcats, format="%Y%m%d:%H").values[tcode] + offset
+        kcode, kcats = pd.factorize(data.type.values)
+        order = list(tpsr_abbrv) + [t for t in se_entsoe_types.values() if t not in tpsr_abbrv]
+        types = [t for t in order if t in kcats] + [t for t in kcats if t not in order]
+
+        ti = time.get_indexer(times)
+        ai = pd.Index(areas).get_indexer(data.area.values)
+        ki = pd.Index(types).get_indexer(kcats)[kcode]
+        keep = (ti >= 0) & (ai >= 0)
+        values = np.full((len(time), len(areas), len(types)), np.nan)
+        values[ti[keep], ai[keep], ki[keep]] = data.gen.values[keep].astype(float)  # last duplicate kept
+        if len(data) == 0:
+            logger.info("No generation data for {0} - {1}".format(starttime, endtime))
+        return time, types, values
+
     def select_gen_per_type_wrap(
         self,
         starttime="20180101:00",
@@ -1006,12 +994,14 @@ class Database:
         thermal=["Biomass", "Brown coal", "Coal-gas", "Gas", "Hard coal", "Oil", "Oil shale", "Peat", "Waste"],
         hydro=["Hydro ror", "Hydro res", "Hydro pump"],
         wind=["Wind offsh", "Wind onsh"],
+        aggregate=False,
     ):
         """
-        Wrapper for select functions. Selects data from ENTSO-E for non-SE regions, and from
-        SvK for SE regions. ENTSO-E data is also time-displaced one hour to fix time lag.
-        Also the aggregate production for categories 'Hydro' and 'Thermal' are computed
-        according to the given definitions.
+        Wrapper for select_gen_per_type_array, returns dict with one data frame (time x type)
+        for each area, columns with only NaN are removed. Selects data from ENTSO-E for non-SE
+        regions, and from SvK for SE regions. ENTSO-E data is also time-displaced one hour to
+        fix time lag. With aggregate=True the aggregate production for categories 'Hydro',
+        'Thermal' and 'Wind' are computed for non-SE regions according to the given definitions.
 
         Thermal: ['Biomass',Brown coal','Coal-gas','Gas','Hard coal','Oil','Oil shale','Peat','Waste']
         'B01':'Biomass',
@@ -1024,47 +1014,36 @@ class Database:
         'B08':'Peat',
         Waste
         """
-        # get data
-        pd_data = self.select_gen_per_type_data(
-            areas=[a for a in areas if "SE" not in a],
-            starttime=(str_to_date(starttime) + datetime.timedelta(hours=-1)).strftime("%Y%m%d:%H"),
-            endtime=(str_to_date(endtime) + datetime.timedelta(hours=-1)).strftime("%Y%m%d:%H"),
-        )
-        pd_data_se = self.select_se_gen_per_type_data(starttime=starttime, endtime=endtime)
-
-        # index = pd.date_range(start=str_to_date(starttime),end=str_to_date(endtime),freq='h')
-
-        # correct index for ENTSO-E data: UTC -> UTC + 1
-        for area in pd_data:
-            new_index = [t + datetime.timedelta(hours=1) for t in pd_data[area].index]
-            pd_data[area].index = new_index
-
-        # aggregate hydro and thermal generation (this is now done in Nordic490 script to keep control)
-        """
-        for area in pd_data:
-            pd_data[area].loc[:,'Hydro'] = pd_data[area].loc[:,[h for h in hydro if h in pd_data[area].columns]].sum(axis=1)
-            pd_data[area].loc[:,'Thermal'] = pd_data[area].loc[:,[h for h in thermal if h in pd_data[area].columns]].sum(axis=1)
-            pd_data[area].loc[:,'Wind'] = pd_data[area].loc[:,[h for h in wind if h in pd_data[area].columns]].sum(axis=1)
-        """
-
-        # copy SE data into pd_data
-        for area in [a for a in areas if "SE" in a]:
-            pd_data[area] = pd.DataFrame(index=pd_data_se[area].index, columns=["Hydro", "Thermal", "Solar"])
-            pd_data[area].loc[:, "Hydro"] = pd_data_se[area].loc[:, "Hydro"]
-            pd_data[area].loc[:, "Thermal"] = pd_data_se[area].loc[:, "CHP"]
-
-            if "Nuclear" in pd_data_se[area].columns:
-                pd_data[area].loc[:, "Nuclear"] = pd_data_se[area].loc[:, "Nuclear"]
-            if "Wind" in pd_data_se[area].columns:
-                pd_data[area].loc[:, "Wind"] = pd_data_se[area].loc[:, "Wind"]
-            if "Solar" in pd_data_se[area].columns:
-                pd_data[area].loc[:, "Solar"] = pd_data_se[area].loc[:, "Solar"]
+        time, types, values = self.select_gen_per_type_array(starttime=starttime, endtime=endtime, areas=areas)
+
+        if aggregate:
+            main = ["Hydro", "Thermal", "Wind"]
+            key = dict([(t, "Thermal") for t in thermal] + [(t, "Hydro") for t in hydro] + [(t, "Wind") for t in wind])
+            ind = [n for n, t in enumerate(types) if t in key and t not in main]
+            G = group_matrix([types[n] for n in ind], main, key)
+            agg = np.nan_to_num(values[:, :, ind]) @ G  # nan counted as 0, as DataFrame.sum
+            has = ~np.isnan(values[:, :, ind]).all(axis=(0, 2))  # areas with ENTSO-E types, i.e. not SE
+            extra = [t for t in main if t not in types]
+            values = np.concatenate([values, np.full((len(time), len(areas), len(extra)), np.nan)], axis=2)
+            types = types + extra
+            for k, t in enumerate(main):
+                values[:, has, types.index(t)] = agg[:, has, k]
+
+        # columns in order of SvK types for SE areas and ENTSO-E types for other areas, as before
+        se_order = {t: i for i, t in enumerate(se_entsoe_types.values())}
+        order = {t: i for i, t in enumerate(list(tpsr_abbrv) + ["Hydro", "Thermal", "Wind"])}
+        pd_data = {}
+        for n, area in enumerate(areas):
+            rank = se_order if "SE" in area else order
+            cols = np.flatnonzero(~np.isnan(values[:, n, :]).all(axis=0))
+            cols = sorted(cols, key=lambda k: rank.get(types[k], len(rank)))
+            pd_data[area] = pd.DataFrame(values[:, n, cols], index=time, columns=[types[k] for k in cols])
         return pd_data
 
     def drop_tables(self):
         """Drop all tables"""
         # make sqlite database
-        conn = sqlite3.connect(self.db)
+        conn = connect_db(self.db)
         c = conn.cursor()
 
         # drop all tables
@@ -1072,9 +1051,10 @@ class Database:
         for tab in c.fetchall():
             c.execute("DROP TABLE '{0}'".format(tab[0]))
         conn.commit()
+        conn.close()
 
 
-def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101", file=None):
+def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101", file=None, downloader=None):
     """Get generation data (actual generation or installed capacity) from
     ENTSO-E transparency database.
     Input:
@@ -1086,6 +1066,8 @@ def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101"
         start - start date
         end - end date
         file - name of xml file to write
+        downloader - entsoe_download.Downloader used for the request (keep-alive session,
+                     rate limit, retries and optional response cache), by default a shared downloader
     Output:
         data - list containing the returned time series
     Notes:
@@ -1096,10 +1078,120 @@ def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101"
     data has hourly frequency.
     """
 
-    req_par = {}
-    req_url = "https://transparency.entsoe.eu/api?"
-    req_token = "a954a1fe-a63e-4c55-84a8-425c35484edb"
+    req_par = entsoe_params(datatype, area, start, end)
+    if req_par is None:
+        return None
+    r = (downloader or default_downloader()).get(req_par)
+    if r is None:
+        logger.info("No response from ENTSO-E for {0} {1}-{2}".format(area, start, end))
+        return None
+    if r.status_code != requests.codes.ok:
+        try:
+            root = ElementTree.fromstring(r.content)
+        except ElementTree.ParseError:
+            logger.info("Invalid query: HTTP {0}".format(r.status_code))
+            return None
+        doctype = root.tag[0 : root.tag.find("}") + 1]
+        errormsg = root.findall(doctype + "Reason/" + doctype + "text")
+        if not errormsg == []:
+            logger.info("Invalid query: " + errormsg[0].text)
+        else:
+            logger.info("Could not find <Reason> in xml document")
+        return None
 
+    # query was ok
+    data = parse_entsoe_xml(r.content)
+
+    if file is not None:
+        with open(file, "wb") as f:
+            f.write(r.content)
+
+    return data
+
+
+# time step for each resolution, P1Y is handled separately
+resolution_step = {
+    "PT15M": np.timedelta64(15, "m"),
+    "PT30M": np.timedelta64(30, "m"),
+    "PT60M": np.timedelta64(60, "m"),
+    "P1D": np.timedelta64(1, "D"),
+    "P7D": np.timedelta64(7, "D"),
+}
+
+
+def parse_entsoe_xml(content):
+    """Decode ENTSO-E xml document (bytes) into list with a dict for each TimeSeries, with its
+    text fields, "Period" (pd.Series, index is period start time in UTC), "MktPSRType" (psrType),
+    "id" and "name" (PowerSystemResources) and "production_type".
+    The document is parsed incrementally, each TimeSeries is released after it has been decoded."""
+
+    data = []
+    ns = None
+    for event, elem in ElementTree.iterparse(io.BytesIO(content), events=("start", "end")):
+        if ns is None:  # root element, extract prefix
+            root = elem
+            ns = elem.tag[0 : elem.tag.find("}") + 1]
+            continue
+        if event == "end" and elem.tag == ns + "TimeSeries":
+            data.append(parse_time_series(elem, ns))
+            root.clear()  # drop decoded TimeSeries
+    return data
+
+
+def parse_time_series(elem, ns):
+    """Decode TimeSeries element, see parse_entsoe_xml"""
+    ts = {}
+    periods = []
+    for e in elem:
+        field = e.tag[len(ns) :]
+        if field == "Period":
+            periods.append(parse_period(e, ns))
+        elif field == "MktPSRType":
+            ts[field] = e[0].text
+            system_resource = e.find(ns + "PowerSystemResources")
+            if system_resource is not None:
+                ts["id"] = system_resource[0].text
+                ts["name"] = system_resource[1].text
+        else:
+            ts[field] = e.text
+    if periods:
+        ts["Period"] = periods[0] if len(periods) == 1 else pd.concat(periods)
+    if "MktPSRType" in ts:
+        ts["production_type"] = tpsr_rabbrv[ts["MktPSRType"]]
+    return ts
+
+
+def parse_period(elem, ns):
+    """Decode Period element into pd.Series with values (float) at the start time of each position.
+    Positions missing in the document (curve type A03) are NaN."""
+    start = elem.find(ns + "timeInterval/" + ns + "start").text
+    resolution = elem.find(ns + "resolution").text
+    points = elem.findall(ns + "Point")
+    pos = np.array([p[0].text for p in points], dtype=int) - 1
+    values = np.full(pos.max() + 1 if len(pos) else 0, np.nan)
+    values[pos] = np.array([p[1].text for p in points], dtype=float)
+
+    t0 = np.datetime64(start[:16], "m")  # e.g. '2015-12-31T23:00Z'
+    if resolution == "P1Y":
+        year = t0.astype("datetime64[Y]")
+        times = (year + np.arange(len(values))).astype("datetime64[m]") + (t0 - year)
+    else:
+        times = t0 + np.arange(len(values)) * resolution_step[resolution]
+    return pd.Series(values, index=pd.DatetimeIndex(times.astype("datetime64[ns]")))
+
+
+def hourly(period):
+    """Series from parse_period with hourly values as stored in the databases ('YYYYMMDD:HH'):
+    sub-hourly values (PT15M, PT30M) are averaged over each hour, other series are unchanged"""
+    if len(period) > 1 and (period.index[1:] - period.index[:-1]).min() < pd.Timedelta(hours=1):
+        return period.resample("h").mean()
+    return period
+
+
+def entsoe_params(datatype=1, area="SE1", start="20160101", end="20160101"):
+    """Query parameters (without security token) for get_entsoe_gen_data, None for wrong datatype"""
+
+    req_par = {}
     if datatype == 1:  # Installed capacity per type
         req_par["documentType"] = "A68"
         req_par["processType"] = "A33"
@@ -1113,7 +1205,7 @@ def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101"
         req_par["documentType"] = "A73"
         req_par["processType"] = "A16"
     else:
-        logger.info("Wrong data type " "%i" "".format())
+        logger.info("Wrong data type {0}".format(datatype))
         return None
 
     req_par["In_Domain"] = tbidz_key[area]
@@ -1124,92 +1216,38 @@ def get_entsoe_gen_data(datatype=1, area="SE1", start="20160101", end="20160101"
     req_par["periodStart"] = start + "0000"
     if datatype == 4:
         # can only obtain one day of data
-        # req_par['periodEnd'] = start+'2300'
         edate = sdate + datetime.timedelta(days=1)
     else:
-        # req_par['periodEnd'] = end+'2300'
         edate += datetime.timedelta(days=1)
     req_par["periodEnd"] = edate.strftime("%Y%m%d") + "0000"
 
-    # logger.info(edate.strftime("%Y%m%d"))
-    send_par = []
-    for f in req_par.keys():
-        if not req_par[f] == "":
-            send_par.append(f)
-
-    query = req_url + "securityToken=" + req_token + "&"
-    for i, f in enumerate(send_par):
-        query = query + f + "=" + req_par[f]
-        if i < send_par.__len__() - 1:
-            query = query + "&"
-
-    r = requests.get(query)
-    root = ElementTree.fromstring(r.content)
-
-    # extract prefix
-    idx = root.tag.find("}")
-    doctype = root.tag[0 : idx + 1]
-
-    if r.status_code == requests.codes.ok:
-        # query was ok
-
-        time_series = root.findall(doctype + "TimeSeries")
-        data = []
-        for t in time_series:
-            ts = {}
-            # read fields
-            for e in t:
-                field = e.tag[idx + 1 :]
-                if field == "Period":
-                    # process data
-                    start = e.findall(doctype + "timeInterval/" + doctype + "start")[0].text
-                    end = e.findall(doctype + "timeInterval/" + doctype + "end")[0].text
-                    resolution = e.findall(doctype + "resolution")[0].text
-                    resolution_key = {"PT60M": "h", "P1Y": "Y"}
-
-                    # create panda time series
-                    edate = datetime.datetime(int(end[0:4]), int(end[5:7]), int(end[8:10]))
-                    # if yearly resolution, set start date one year before end date
-                    if resolution_key[resolution] == "Y":
-                        sdate = edate + datetime.timedelta(days=-365)
-                    else:  # hourly resolution, take hours into account
-                        edate = datetime.datetime(int(end[0:4]), int(end[5:7]), int(end[8:10]), int(end[11:13]))
-                        sdate = datetime.datetime(int(start[0:4]), int(start[5:7]), int(start[8:10]), int(start[11:13]))
-
-                    alen = e.__len__() - 2
-                    dates = pd.date_range(start=sdate, end=edate, freq=resolution_key[resolution])
-                    dates = dates[0:alen]  # remove last time, as we only want starting time for each period
-
-                    ts["Period"] = pd.Series(np.zeros(alen, dtype=float), index=dates)
-                    for i, point in enumerate(e[2:]):
-                        ts["Period"][i] = float(point[1].text)
-                elif field == "MktPSRType":
-                    ts[field] = e[0].text
-                    system_resource = e.findall(doctype + "PowerSystemResources")
-                    if not system_resource == []:
-                        ts["id"] = system_resource[0][0].text
-                        ts["name"] = system_resource[0][1].text
-
-                else:
-                    ts[field] = e.text
-            data.append(ts)
-
-            for d in data:
-                if "MktPSRType" in d:
-                    d["production_type"] = tpsr_rabbrv[d["MktPSRType"]]
-    else:
-        errormsg = root.findall(doctype + "Reason/" + doctype + "text")
-        if not errormsg == []:
-            logger.info("Invalid query: " + errormsg[0].text)
-        else:
-            logger.info("Could not find <Reason> in xml document")
-        return None
-
-    if file is not None:
-        tree = ElementTree.ElementTree(root)
-        tree.write(file)
-
-    return data
+    return {f: v for f, v in req_par.items() if v != ""}
+
+
+def pivot_gen_data(data, areas, types):
+    """Pivot rows (gen, time, type, area) with time 'YYYYMMDD:HH' into dict with one data frame
+    (time x type) for each area, with hourly index from the first to the last time.
+    Types not in types are added at the end, columns with only NaN are removed."""
+
+    tcode, times = pd.factorize(data.time.values)  # each time parsed once
+    times = pd.to_datetime(times, format="%Y%m%d:%H")
+    dates = pd.date_range(start=times.min(), end=times.max(), freq="h")
+    acode, acats = pd.factorize(data.area.values)
+    kcode, kcats = pd.factorize(data.type.values)
+    types = list(types) + [k for k in kcats if k not in types]
+
+    ti = dates.get_indexer(times)[tcode]
+    ai = pd.Index(areas).get_indexer(acats)[acode]
+    ki = pd.Index(types).get_indexer(kcats)[kcode]
+    keep = ai >= 0
+    values = np.full((len(dates), len(areas), len(types)), np.nan)  # time x area x type
+    values[ti[keep], ai[keep], ki[keep]] = data.gen.values[keep].astype(float)  # last duplicate kept
+
+    gdata = {}
+    for n, area in enumerate(areas):
+        cols = ~np.isnan(values[:, n, :]).all(axis=0)
+        gdata[area] = pd.DataFrame(values[:, n, cols], index=dates, columns=[t for t, c in zip(types, cols) if c])
+    return gdata
 
 
 def aggregate_gen_per_type_data(pd_data):
@@ -6,6 +6,8 @@ Created on Mon Jan 14 10:03:38 2019
 """
 # import difflib
 import datetime
+import sqlite3
+from pathlib import Path
 
 import numpy as np
 import openpyxl
@@ -146,6 +148,65 @@ def intersection(lst1, lst2):
     return lst3
 
 
+def group_matrix(items, groups, key):
+    """Matrix (items x groups) with a 1 in column groups.index(key[item]) for each item,
+    e.g. to sum generation per type into main types with data @ matrix"""
+    M = np.zeros((len(items), len(groups)))
+    for i, item in enumerate(items):
+        M[i, groups.index(key[item])] = 1
+    return M
+
+
+def connect_db(db, readonly=False, mmap_size=2**28, cache_mb=64):
+    """Open sqlite connection with tuned PRAGMAs.
+    readonly=True: opened in read-only mode with query_only, for long-lived reader connections
+    readonly=False: WAL journal (readers are not blocked while writing) and synchronous=NORMAL"""
+    if readonly:
+        conn = sqlite3.connect(Path(db).absolute().as_uri() + "?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only=ON")
+    else:
+        conn = sqlite3.connect(db)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA mmap_size={0}".format(mmap_size))
+    conn.execute("PRAGMA cache_size={0}".format(-1024 * cache_mb))  # negative -> KiB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class DatabaseConnection:
+    """Long-lived read-only connection for database classes with the file name in self.db.
+    Can be used as a context manager, the connection is closed on exit."""
+
+    conn = None
+
+    def connect(self):
+        """Read-only connection to self.db, opened on first use and kept until close()"""
+        if self.conn is None:
+            self.conn = connect_db(self.db, readonly=True)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def category_order(conn, table):
+    """Categories (areas or transfers) of table in their order in the original table,
+    as stored in table category_order by nordpool_db.migrate. Empty list if not stored."""
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='category_order'").fetchone() is None:
+        return []
+    rows = conn.execute("SELECT category FROM category_order WHERE tab = ? ORDER BY pos", (table,))
+    return [row[0] for row in rows]
+
+
 def str_to_date(strdate):
     """Take a string with a date and return datetime object
     Allowed formats:
@@ -170,6 +231,16 @@ def str_to_date(strdate):
         return datetime.datetime(year, month, day)
 
 
+def time2int(time, weekly=False):
+    """Integer time as in indexed nordpool tables: 'YYYYMMDD:HH' -> hours since 19700101:00,
+    'YYYY:WW' -> YYYYWW (weekly=True). Shorter strings are padded, e.g. '2018' -> '20180101:00'"""
+    if weekly:
+        return int(time[0:4]) * 100 + int(time[5:7] or 1)
+    time = time + "19700101:00"[len(time) :]
+    date = datetime.datetime(int(time[0:4]), int(time[4:6]), int(time[6:8]))
+    return (date - datetime.datetime(1970, 1, 1)).days * 24 + int(time[9:11])
+
+
 def week_to_date(weekstr):
     """Given week in format 'YYYY:WW' return datetime object with date for start of week"""
     year = int(weekstr[0:4])
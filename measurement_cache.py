@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Disk cache for measurements from N490.get_measurements.
+
+An entry holds load, generation, HVDC link flows, measured AC flows and the
+nan repair counts (N490.nan_stats) for a range of hours, stored in a compressed
+.npz file named by the key and the first and last hour, e.g.
+<key>_2018010100_2018013123.npz. Only requests for exactly the same hours are
+served from an entry: the nan repair in get_measurements depends on where the
+period ends, so a slice of a longer entry could differ from a fresh read.
+When the total size exceeds max_mb the least recently used entries are removed.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("Nordic490.measurement_cache")
+
+version = 3  # included in the keys, increase when the processing in get_measurements changes
+frames = ["load", "gen", "link", "flow"]
+
+
+class MeasurementCache:
+    def __init__(self, path="Data/cache/measurements", max_mb=1024):
+        """path: folder for cached entries, max_mb: max total size of entries (MB)"""
+        self.path = path
+        self.max_mb = max_mb
+
+    def file(self, key, time):
+        """Entry for key and the hours in time"""
+        return os.path.join(
+            self.path, "%s_%s_%s.npz" % (key, time[0].strftime("%Y%m%d%H"), time[-1].strftime("%Y%m%d%H"))
+        )
+
+    def get(self, key, time):
+        """Cached (load, gen, link, flow, nan_stats) for the hours in time, None if not cached"""
+        time = pd.DatetimeIndex(time)
+        file = self.file(key, time)
+        try:
+            with np.load(file) as data:
+                if not time.equals(pd.DatetimeIndex(data["time"])):
+                    return None
+                res = tuple(self.frame(data, name, time) for name in frames)
+                nan_stats = pd.DataFrame(
+                    data["nan_stats"], index=data["nan_stats_index"], columns=data["nan_stats_columns"]
+                )
+        except (OSError, ValueError, KeyError):  # not cached, removed or incomplete file
+            return None
+        os.utime(file)  # mark as recently used
+        logger.debug("Measurements for %s - %s read from %s" % (time[0], time[-1], file))
+        return res + (nan_stats,)
+
+    def frame(self, data, name, time):
+        """DataFrame name from the arrays in data"""
+        if name + "_type" in data:  # (area, type) columns
+            columns = pd.MultiIndex.from_arrays(
+                [data[name + "_columns"], data[name + "_type"]], names=["area", "type"]
+            )
+        else:
+            columns = pd.Index(data[name + "_columns"])
+        return pd.DataFrame(data[name], index=time, columns=columns)
+
+    def put(self, key, load, gen, link, flow, nan_stats):
+        """Store measurements with the same (hourly) index and nan repair counts per area,
+        then evict old entries"""
+        time = pd.DatetimeIndex(load.index)
+        file = self.file(key, time)
+        arrays = {"time": time.values}
+        arrays["nan_stats"] = nan_stats.to_numpy()
+        arrays["nan_stats_index"] = np.asarray(list(nan_stats.index))
+        arrays["nan_stats_columns"] = np.asarray(list(nan_stats.columns))
+        for name, df in zip(frames, [load, gen, link, flow]):
+            arrays[name] = df.to_numpy(dtype=float)
+            if isinstance(df.columns, pd.MultiIndex):
+                arrays[name + "_columns"] = np.asarray(list(df.columns.get_level_values(0)))
+                arrays[name + "_type"] = np.asarray(list(df.columns.get_level_values(1)))
+            else:
+                arrays[name + "_columns"] = np.asarray(list(df.columns))
+        os.makedirs(self.path, exist_ok=True)
+        tmp = file + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, file)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the total size is below max_mb"""
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".npz")]
+        stats = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files)
+        total = sum(s[1] for s in stats)
+        for _, size, f in stats:
+            if total <= self.max_mb * 2**20:
+                break
+            os.remove(f)
+            total -= size
+            logger.debug("Removed %s from measurement cache" % f)
+
+    def clear(self):
+        """Remove all entries"""
+        for f in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            if f.endswith(".npz"):
+                os.remove(os.path.join(self.path, f))
@@ -10,14 +10,17 @@ Edited
 
 """
 
+import copy
 import logging
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from numpy import atleast_1d as arr
 from numpy import flatnonzero as find
 from pypower.api import ppoption, rundcpf
@@ -26,11 +29,39 @@ from scipy.spatial.distance import cdist
 
 import entsoe_transparency_db as entsoe
 import nordpool_db as nordpool
+from ac_solver import ACSolver
+from dc_solver import DCSolver, topology_key
+from help_functions import group_matrix
+from measurement_cache import MeasurementCache
+from measurement_cache import version as measurement_version
 from network_map import Map
+from result_store import ResultStore
 
 logger = logging.getLogger("Nordic490.nordic490")
 
 warnings = False  # Display warnings
+worker_net = None  # read-only copy of the network in time_series worker processes
+
+# Main gen type for each entso-e type
+gen_key = {
+    "Biomass": "Thermal",
+    "Gas": "Thermal",
+    "Hard coal": "Thermal",
+    "Hydro": "Hydro",
+    "Hydro res": "Hydro",
+    "Hydro ror": "Hydro",
+    "Nuclear": "Nuclear",
+    "Oil": "Thermal",
+    "Other": "Thermal",
+    "Other renew": "Thermal",
+    "Peat": "Thermal",
+    "Solar": "Wind",
+    "Thermal": "Thermal",
+    "Waste": "Thermal",
+    "Wind": "Wind",
+    "Wind offsh": "Wind",
+    "Wind onsh": "Wind",
+}
 
 
 def mult_ind(a, b, miss=np.nan):
@@ -43,10 +74,89 @@ def mult_ind(a, b, miss=np.nan):
     return arr([bind.get(itm, miss) for itm in a])
 
 
+def interpolate_nan(x, limit=10):
+    """Interpolate nans linearly along axis 0 of array x (in place) as DataFrame.interpolate(limit=limit):
+    at most limit nans after a valid value are filled, nans after the last valid value get that value
+    and leading nans are kept. Returns number of filled values (x.shape[1:])"""
+    n = x.shape[0]
+    y = x.reshape(n, -1)
+    filled = np.zeros(y.shape[1], dtype=int)
+    c = find(np.isnan(y).any(axis=0))  # only columns with nans
+    if len(c) > 0:
+        z = np.ascontiguousarray(y[:, c].T)  # column x time
+        nan = np.isnan(z)
+        t = np.arange(n)
+        prev = np.maximum.accumulate(np.where(nan, -1, t), axis=1)  # last valid value at or before t
+        nxt = np.minimum.accumulate(np.where(nan, n, t)[:, ::-1], axis=1)[:, ::-1]  # next valid value
+        fill = nan & (prev >= 0) & (t - prev <= limit)
+        i, j = np.nonzero(fill)
+        p, q = prev[i, j], nxt[i, j]
+        x0 = z[i, p]
+        x1 = z[i, np.minimum(q, n - 1)]
+        z[i, j] = np.where(q < n, x0 + (x1 - x0) * (j - p) / np.maximum(q - p, 1), x0)
+        y[:, c] = z.T
+        filled[c] = fill.sum(axis=1)
+        x[...] = y.reshape(x.shape)  # if reshape made a copy
+    return filled.reshape(x.shape[1:])
+
+
+def repair_entsoe(data, time, areas, limit=10):
+    """Handle DST shift and interpolate remaining nans in entso-e data (hour x area x type), in place.
+    At the last sunday in october 02:00, an area with nans where the hour before is more than 1.5 times
+    the hour before that gets half of the hour before in both hours.
+    Returns DataFrame with number of values filled (dst, interpolated) and remaining nans for each area."""
+
+    time = pd.DatetimeIndex(time)
+    s = find((time.month == 10) & (time.weekday == 6) & (time.hour == 2) & (time.day > 24))  # DST shift hours
+    s = s[s >= 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shift = np.isnan(data[s]).any(axis=2) & (data[s - 1].sum(axis=2) / data[s - 2].sum(axis=2) > 1.5)
+    i, a = np.nonzero(shift)  # shift hour, area
+    dst = np.bincount(a, np.isnan(data[s[i], a]).sum(axis=1), minlength=len(areas)).astype(int)
+    data[s[i] - 1, a] /= 2
+    data[s[i], a] = data[s[i] - 1, a]
+
+    interpolated = interpolate_nan(data, limit).sum(axis=1)  # per area
+    remaining = np.isnan(data).sum(axis=(0, 2))
+    return pd.DataFrame({"dst": dst, "interpolated": interpolated, "remaining": remaining}, index=areas)
+
+
+def init_worker(net):
+    """Store network copy in time_series worker process"""
+    global worker_net
+    worker_net = net
+
+
+def solve_chunk(load, gen, link, columns, mode="dc"):
+    """Distribute power and run DCPF (or ACPF) for a chunk of hours in a worker process.
+    Returns modelled interarea flows, solved cases and AC convergence info for the chunk."""
+    net = worker_net
+    net.reset_results(load.index)
+    net.flow_modelled = pd.DataFrame(0.0, index=load.index, columns=columns)
+    P = net.bus_injections(load, gen, link, gen_equals_load=True)
+    if mode == "ac":
+        net.acpf_series(P)
+    else:
+        net.dcpf_batch(P)
+    res = net.results
+    return net.flow_modelled, res.solved, res.angle.T, res.flow.T, res.vm.T, net.ac_stats
+
+
 class N490:
-    def __init__(self, topology_file="Data", year=True, set_branch_params=False):
+    def __init__(
+        self,
+        topology_file="Data",
+        year=True,
+        set_branch_params=False,
+        cache_dir="Data/cache",
+        results_dir=None,
+        parquet_dir=None,
+    ):
         """Initiate object
-        year: remove too old or not yet built. None -> include everything, True -> current year"""
+        year: remove too old or not yet built. None -> include everything, True -> current year
+        cache_dir: folder for cached PTDF/LODF matrices, measurements etc., None -> no caching on disk
+        results_dir: folder for memory mapped results (angles, flows), None -> keep in memory
+        parquet_dir: Parquet store with ENTSO-E and Nordpool data (see parquet_store), None -> sqlite only"""
 
         self.baseMVA = 100.0  # base MVA
         self.dfs = [
@@ -81,7 +191,18 @@ class N490:
         self.prepare_network(year)  # possibly remove too new or old data, check islands
         self.flow_measured = []  # store measured AC flows between areas
         self.flow_modelled = []  # store modelled -"- from e.g. dcpf()
-        self.solved_mpc = []  # store solved cases
+        self.results = None  # solved cases (angles and branch flows per hour), see reset_results()
+        self.results_dir = results_dir
+        self.parquet_dir = parquet_dir
+        self.dc = None  # cached DC solver (factorized B'), see dc_solver()
+        self.ac = None  # cached AC solver (Ybus, last solution), see ac_solver()
+        self.ac_stats = None  # AC power flow iterations and convergence per hour
+        self.nan_stats = None  # nans in entso-e data repaired per area (last read from the databases)
+        self.alloc = None  # cached operators for distributing power, see allocation()
+        self.intf = None  # cached interface incidence matrix, see interfaces()
+        self.exch = None  # cached links and AC lines between areas, see exchange_map()
+        self.cache_dir = cache_dir
+        self.measurements = None  # cache for get_measurements, see measurement_cache()
         self.time = 0  # store time when downloading from entso-e and nordpool
         if set_branch_params:
             self.branch_params()
@@ -267,85 +388,50 @@ class N490:
         trafo["B"] = 0
 
     def mpc2network(self, num=0):
-        """Extract data (flows etc) from solved case and add info to self.bus etc.
+        """Extract data (flows etc) from solved case for hour number num and add info to self.bus etc.
         More parameters to be added later (e.g. after AC simulation)"""
-        mpc = self.solved_mpc[num][0]
-        self.bus["angle"] = mpc["bus"][:, 8]
-        line = mpc["branch"][mpc["branch"][:, 8] == 0]
-        self.line["flow"] = line[:, 13]
-        trafo = mpc["branch"][mpc["branch"][:, 8] == 1]
-        self.trafo["flow"] = trafo[:, 13]
-
-    def get_measurements(self, start, stop=None, adjust_gen=True):
+        res = self.results[num]
+        self.bus["angle"] = res["Va"].astype(float)
+        if not np.isnan(res["Vm"]).all():  # AC solution
+            self.bus["Vm"] = res["Vm"].astype(float)
+        self.line["flow"] = res["Pf"][: len(self.line)].astype(float)
+        self.trafo["flow"] = res["Pf"][len(self.line) :].astype(float)
+
+    def reset_results(self, time=None):
+        """Allocate result store for the hours in time (default self.time), see ResultStore"""
+        if time is None:
+            time = self.time
+        self.results = ResultStore(time, len(self.bus), len(self.line) + len(self.trafo), self.results_dir)
+        self.ac_stats = pd.DataFrame(index=self.results.time, columns=["iterations", "converged", "mismatch"])
+
+    def measurement_cache(self):
+        """Cache for get_measurements in cache_dir (None if no cache_dir), see MeasurementCache"""
+        if self.measurements is None and self.cache_dir is not None:
+            self.measurements = MeasurementCache(os.path.join(self.cache_dir, "measurements"))
+        return self.measurements
+
+    def measurement_key(self, adjust_gen):
+        """Key for cached measurements: adjust_gen, areas of links and lines and modification time of the databases"""
+        files = [entsoe.Database().db, nordpool.Database().db, self.parquet_dir]
+        mtime = [os.path.getmtime(f) if f is not None and os.path.exists(f) else 0 for f in files]
+        return topology_key(
+            [measurement_version, adjust_gen] + mtime,
+            pd.util.hash_array(np.array(self.bidz + self.country, dtype=object)),
+            pd.util.hash_pandas_object(self.link.loc[:, ["area0", "area1"]]).values,
+            pd.util.hash_pandas_object(self.line.loc[:, ["area0", "area1"]], index=False).values,
+        )
+
+    def get_measurements(self, start, stop=None, adjust_gen=True, cache=True):
         """Import load, generation per type and HVDC from entso-e and Nordpool.
         start/stop can be strings 'yyyymmdd:hh' or pd.Timestamp (UTC+1)
         adjust_gen: True to adjust entso-e data based on Nordpool totals
+        cache: True to use cached measurements for the same period (see measurement_cache)
         data for 2015-2018 is available (entsoe_transparency_db and nordpool_db to download more).
         """
 
-        # Main gen type for each entso-e type
-        gen_key = {
-            "Biomass": "Thermal",
-            "Gas": "Thermal",
-            "Hard coal": "Thermal",
-            "Hydro": "Hydro",
-            "Hydro res": "Hydro",
-            "Hydro ror": "Hydro",
-            "Nuclear": "Nuclear",
-            "Oil": "Thermal",
-            "Other": "Thermal",
-            "Other renew": "Thermal",
-            "Peat": "Thermal",
-            "Solar": "Wind",
-            "Thermal": "Thermal",
-            "Waste": "Thermal",
-            "Wind": "Wind",
-            "Wind offsh": "Wind",
-            "Wind onsh": "Wind",
-        }
-
-        # Adjust exchange areas from Nordpool, e.g. SE-PL becomes SE4-PL
-        exch_fix = {
-            "SE-PL": "SE4-PL",
-            "SE-DE": "SE4-DE",
-            "NO-DK": "NO2-DK1",
-            "NO-NL": "NO2-NL",
-            "NO-FI": "NO4-FI",
-            "NO-RU": "NO4-RU",
-        }
-
         def timestamp(s):
             return pd.to_datetime(s, format="%Y%m%d:%H")  # 'yyyymmdd:hh' to pd.Timestamp
 
-        def empty_df(area, typ, time, fill=0.0):
-            """Make empty DataFrame with (area,type) as columns and time as index."""
-            index = pd.MultiIndex.from_product([area, typ], names=["area", "type"])
-            df = pd.DataFrame(fill, index=time, columns=index)
-            return df
-
-        def fix_entsoe(dic, limit=10):
-            """Handle DST shift and interpolate remaining nans.
-            Error if time starts with last sunday in october 02:00..."""
-
-            time = dic[list(dic)[0]].index
-            month, day, wd, hour = time.month, time.day, time.weekday, time.hour
-            shift = find((month == 10) & (wd == 6) & (hour == 2) & (day > 24))  # DST shift hours in October
-            for i, df in dic.items():
-                if i in self.bidz:
-                    # DST shift in October
-                    for s in shift:
-                        if sum(np.isnan(df.iloc[s, :])) > 0 and sum(df.iloc[s - 1, :]) / sum(df.iloc[s - 2, :]) > 1.5:
-                            df.iloc[s - 1, :] /= 2
-                            df.iloc[s, :] = df.iloc[s - 1, :]
-
-                    # Remaining nans
-                    df = df.astype(float)
-                    df.interpolate(limit=limit, inplace=True)  # interpolate up to limit samples
-
-                    if df.isna().sum().sum() > 0:
-                        logger.info("Too many nans in Entso-e data for %s, might not work properly." % i)
-            return dic
-
         if type(start) == type(pd.Timestamp(2018)):
             start = start.strftime("%Y%m%d:%H")
         if type(stop) == type(pd.Timestamp(2018)):
@@ -356,23 +442,62 @@ class N490:
             time = [timestamp(start)]
             stop = start
 
+        mc = self.measurement_cache() if cache else None
+        res = None
+        if mc is not None:
+            key = self.measurement_key(adjust_gen)
+            res = mc.get(key, time)
+        if res is None:
+            res = self.read_measurements(start, stop, time, adjust_gen) + (self.nan_stats,)
+            if mc is not None:
+                mc.put(key, *res)
+        load, gen, link, ac_flow, self.nan_stats = res
+
+        self.flow_measured = ac_flow
+        self.flow_modelled = pd.DataFrame(0.0, index=time, columns=list(ac_flow))
+        self.time = time
+        self.reset_results()
+
+        return load, gen, link
+
+    def read_measurements(self, start, stop, time, adjust_gen=True):
+        """Read measurements for get_measurements from the databases,
+        returns load, gen, link and measured AC flows between areas"""
+
+        # Adjust exchange areas from Nordpool, e.g. SE-PL becomes SE4-PL
+        exch_fix = {
+            "SE-PL": "SE4-PL",
+            "SE-DE": "SE4-DE",
+            "NO-DK": "NO2-DK1",
+            "NO-NL": "NO2-NL",
+            "NO-FI": "NO4-FI",
+            "NO-RU": "NO4-RU",
+        }
+
         # Entso-e generation
-        db = entsoe.Database()
-        raw = db.select_gen_per_type_wrap(starttime=start, endtime=stop)
-        raw = fix_entsoe(raw)
-        gen = empty_df(self.bidz, self.gen_type, time)
-        for b in self.bidz:
-            for t in list(raw[b]):  # iterate over gen types
-                gen.loc[:, (b, gen_key[t])] += arr(raw[b][t])[0]
+        db = entsoe.Database(parquet=self.parquet_dir)
+        types, data = db.select_gen_per_type_array(starttime=start, endtime=stop, areas=self.bidz)[1:]
+        missing = [t for t in types if t not in gen_key]
+        if missing:
+            raise KeyError("No main gen type for %s" % str(missing))
+        data[:, np.isnan(data).all(axis=0)] = 0  # hour x area x entso-e type, 0 for types without data
+        self.nan_stats = repair_entsoe(data, time, self.bidz)  # DST shift and remaining nans
+        for b in self.nan_stats.index[self.nan_stats.remaining > 0]:
+            logger.info("Too many nans in Entso-e data for %s, might not work properly." % b)
+        G = group_matrix(types, self.gen_type, gen_key)
+        nan = np.isnan(data)
+        gen = np.where(nan, 0.0, data) @ G  # hour x area x main type
+        gen[(nan @ G) > 0] = np.nan  # missing value for one of the entso-e types
 
         # Possibly adjust entso-e generation so sum equals Nordpool
-        db = nordpool.Database()
+        db = nordpool.Database(parquet=self.parquet_dir)
         if adjust_gen:
             gen_np = db.select_data(table="production", starttime=start, endtime=stop)
-            for b in self.bidz:
-                ratio = arr(gen_np[b] / gen.loc[:, b].sum(axis=1))
-                for t in self.gen_type:
-                    gen.loc[:, (b, t)] *= ratio[0]
+            with np.errstate(divide="ignore", invalid="ignore"):  # no entso-e generation -> inf/nan as before
+                ratio = gen_np.reindex(time).loc[:, self.bidz].to_numpy(dtype=float) / np.nansum(gen, axis=2)
+                gen *= ratio[:, :, None]
+        columns = pd.MultiIndex.from_product([self.bidz, self.gen_type], names=["area", "type"])
+        gen = pd.DataFrame(gen.reshape(len(time), -1), index=time, columns=columns)
 
         # Nordpool load
         load = db.select_data(table="consumption", starttime=start, endtime=stop).loc[:, self.bidz]
@@ -385,60 +510,75 @@ class N490:
                 cols[cols.index(k)] = v  # change e.g. SE-PL to SE4-PL
             except ValueError:
                 pass
-        exch = pd.DataFrame(index=time)
-        for e, v in zip(cols, arr(exch_np).T):  # save relevant exchanges
+        names = {}  # relevant exchanges 'a0-a1' in alphabetic order -> (column in exch_np, sign)
+        for n, e in enumerate(cols):
             a0, a1 = e.split("-")
             if a0 in self.bidz or a1 in self.bidz:  # exclude e.g. LV-RU
                 if not (a0 in self.country and a1 in self.country):  # exclude e.g. SE-FI
                     if a0 > a1:
-                        exch.loc[:, "%s-%s" % (a1, a0)] = -v  # in alphabetic order
+                        names["%s-%s" % (a1, a0)] = (n, -1.0)  # in alphabetic order
                     else:
-                        exch.loc[:, "%s-%s" % (a0, a1)] = v
-
-        # DC exchange
-        link = pd.DataFrame(index=time)
+                        names["%s-%s" % (a0, a1)] = (n, 1.0)
+        ind, sign = np.array([names[e][0] for e in names], dtype=int), arr([names[e][1] for e in names])
+        exch = exch_np.to_numpy(dtype=float)[:, ind] * sign  # hour x exchange
+
+        # Map exchanges to links (DC) and AC flows between areas
+        emap = self.exchange_map()
+        L, link_ids = [], []  # (exchange, share) for each link (exchange shared equally, later set based on capacity)
+        A, ac_names = [], []  # (exchange, sign) for each AC flow, "first" bid zone first
         nn = 0  # keep track of Nordpool exchanges with counterpart in model
-        for i in list(exch):
-            a0, a1 = i.split("-")
-            ind1 = self.link.index[(self.link.area0 == a0) & (self.link.area1 == a1)]  # find links between areas
-            ind2 = self.link.index[(self.link.area0 == a1) & (self.link.area1 == a0)]  # -"- but reverse flow direction
+        for k, e in enumerate(names):
+            a0, a1 = e.split("-")
+            ind1 = emap["links"].get((a0, a1), [])  # links between areas
+            ind2 = emap["links"].get((a1, a0), [])  # -"- but reverse flow direction
             num = len(ind1) + len(ind2)  # number of links in model for this exchange
             if num > 0:
                 nn += 1
-                for i1 in ind1:
-                    link.loc[:, i1] = arr(exch.loc[:, i] / num)  # later set exchange based on link capacity
-                for i2 in ind2:
-                    link.loc[:, i2] = -arr(exch.loc[:, i] / num)
-
-        # AC exchange between areas
-        ac_flow = pd.DataFrame(index=time)
-        for i in list(exch):
-            a0, a1 = i.split("-")
-            ind1 = self.line.index[(self.line.area0 == a0) & (self.line.area1 == a1)]  # find lines between areas
-            ind2 = self.line.index[(self.line.area0 == a1) & (self.line.area1 == a0)]  # -"- but reverse flow direction
-            if len(ind1) + len(ind2) > 0:  # we have an AC connection
+                L += [(k, 1.0 / num)] * len(ind1) + [(k, -1.0 / num)] * len(ind2)
+                link_ids += ind1 + ind2
+            if (a0, a1) in emap["ac"]:  # we have an AC connection
                 nn += 1
-                if self.bidz.index(a0) < self.bidz.index(a1):  # "first" bid zone should be first
-                    ac_flow.loc[:, i] = exch.loc[:, i]
+                if self.bidz.index(a0) < self.bidz.index(a1):
+                    A.append((k, 1.0))
+                    ac_names.append(e)
                 else:
-                    ac_flow.loc[:, "%s-%s" % (a1, a0)] = -exch.loc[:, i]
+                    A.append((k, -1.0))
+                    ac_names.append("%s-%s" % (a1, a0))
+
+        def gather(entries):
+            """Column of exch times coefficient for each (exchange, coefficient), nan only if that exchange is"""
+            ind = np.array([k for k, _ in entries], dtype=int)
+            return exch[:, ind] * arr([c for _, c in entries])
+
+        link = pd.DataFrame(gather(L), index=time, columns=link_ids)
+        ac_flow = pd.DataFrame(gather(A), index=time, columns=ac_names)
 
         # Check that all Nordpool exchanges has been taken into account
-        if exch.shape[1] != nn and warnings:
+        if len(names) != nn and warnings:
             logger.info("Some Nordpool exchanges are not included in model")
 
-        self.flow_measured = ac_flow
-        self.flow_modelled = pd.DataFrame(0.0, index=time, columns=list(ac_flow))
-        self.time = time
-
-        return load, gen, link
+        return load, gen, link, ac_flow
 
-    def time_series(self, start, stop):
-        """Download hourly time series between start and stop and run dc power flow for each hour."""
+    def time_series(self, start, stop, batch=True, workers=None, mode="dc"):
+        """Download hourly time series between start and stop and run dc power flow for each hour.
+        batch: True -> solve all hours at once (dcpf_batch), False -> one dcpf call per hour
+        workers: number of processes, the hours are split in chunks solved in parallel
+        (on Windows, call from within if __name__ == "__main__")
+        mode: 'dc' or 'ac' (Newton-Raphson, each hour warm started from the previous, see acpf)"""
 
         logger.info("*** Accessing data from Entso-E and Nordpool ***")
         load, gen, link = self.get_measurements(start, stop)
-        logger.info("*** Distributing power and running DCPF ***")
+        logger.info("*** Distributing power and running %sPF ***" % mode.upper())
+        if workers is not None and workers > 1:
+            self.time_series_parallel(load, gen, link, workers, mode)
+            return
+        if mode == "ac":
+            self.acpf_series(self.bus_injections(load, gen, link, gen_equals_load=True))
+            return
+        if batch:
+            P = self.bus_injections(load, gen, link, gen_equals_load=True)
+            self.dcpf_batch(P)
+            return
         day = "yyyy-mm-dd"  # print progress each day
         for n, t in enumerate(self.time):
             self.distribute_power(load, gen, link, n, gen_equals_load=True)
@@ -447,89 +587,163 @@ class N490:
                 day = t.strftime("%Y-%m-%d")
                 logger.info(day)
 
+    def time_series_parallel(self, load, gen, link, workers, mode="dc"):
+        """Split the hours in load/gen/link in one chunk per worker, run distribution and DCPF
+        (or ACPF for mode='ac') for each chunk in a separate process and merge the results in time order."""
+
+        net = copy.copy(self)  # read-only copy without results and cached solvers
+        net.results, net.flow_measured, net.flow_modelled = None, [], []
+        net.dc, net.ac, net.alloc, net.intf, net.exch = None, None, None, None, None
+        net.results_dir = None
+        columns = list(self.flow_modelled)
+        chunks = [c for c in np.array_split(np.arange(len(load.index)), workers) if len(c) > 0]
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(net,)) as pool:
+            jobs = [
+                pool.submit(solve_chunk, load.iloc[c], gen.iloc[c], link.iloc[c], columns, mode) for c in chunks
+            ]
+            results = [j.result() for j in jobs]  # in time order
+        self.flow_modelled = pd.concat([r[0] for r in results])
+        for c, r in zip(chunks, results):
+            n = self.results.index(load.index[c])[r[1]]  # solved hours in chunk
+            self.results.set(n, r[2][:, r[1]], r[3][:, r[1]], r[4][:, r[1]])
+        self.ac_stats = pd.concat([r[5] for r in results])
+        self.distribute_power(load, gen, link, len(load.index) - 1)  # network state for last hour
+
+    def bus_injections(self, load, gen, link, gen_equals_load=True):
+        """Net bus injections (MW) for all hours in load.index, returns array (bus x hours).
+        The network is left with the distribution for the last hour."""
+
+        res = self.allocate_power(load, gen, link, gen_equals_load=gen_equals_load)
+        self.distribute_power(load, gen, link, len(load.index) - 1, gen_equals_load=gen_equals_load)
+        return self.allocation()["gen_bus"] @ res["gen"] - res["load"]
+
     def distribute_power(self, load, gen, link, time=0, gen_equals_load=True):
         """Determine load, generation at each bus based on bid zone totals.
         time can be integer index of time series or Timestamp."""
 
         if type(time) is int:
             time = load.index[time]
+        res = self.allocate_power(load, gen, link, [time], gen_equals_load)
+        self.gen["P"] = res["gen"][:, 0]
+        self.farms["P"] = res["farms"][:, 0]
+        self.bus["load"] = res["load"][:, 0]
+        self.link["P"] = res["link"][:, 0]
+
+    def allocation(self):
+        """Sparse operators for distributing bid zone totals on generators, wind farms and buses.
+        Columns of gen/farms/curtail are (bid zone, gen type) in the order of cols.
+        Cached, rebuilt if bus, gen, farms or link data has changed."""
+
+        key = topology_key(
+            *[
+                pd.util.hash_pandas_object(df, index=True).values
+                for df in [
+                    self.bus[["bidz", "load_share"]],
+                    self.gen[["bus", "bidz", "type", "Pmax"]],
+                    self.farms[["bus", "bidz", "Pmax"]],
+                    self.link[["bus0", "bus1"]],
+                ]
+            ]
+        )
+        if self.alloc is not None and self.alloc["key"] == key:
+            return self.alloc
+
+        cols = [(b, t) for b in self.bidz for t in self.gen_type]
+        nc, nz, nb = len(cols), len(self.bidz), len(self.bus)
+        bus, gen, farms, link = self.bus, self.gen, self.farms, self.link
+
+        # Generation except wind: share of installed capacity per (bid zone, type)
+        gc = mult_ind(list(zip(gen.bidz, gen.type)), cols).astype(float)
+        gc[arr(gen.type == "Wind")] = np.nan
+        ok = ~np.isnan(gc)
+        Pmax = arr(gen.Pmax).astype(float)
+        available = np.bincount(gc[ok].astype(int), weights=Pmax[ok], minlength=nc)
+
+        # Wind farms
+        fc = mult_ind([(b, "Wind") for b in farms.bidz], cols)
+        fok = ~np.isnan(fc)
+        fPmax = arr(farms.Pmax).astype(float)
+        wind = [cols.index((b, "Wind")) for b in self.bidz]
+        available[wind] = np.bincount(fc[fok].astype(int), weights=fPmax[fok], minlength=nc)[wind]
+
+        ok &= available[np.nan_to_num(gc).astype(int)] > 0
+        fok &= available[np.nan_to_num(fc).astype(int)] > 0
+        gc, fc = gc[ok].astype(int), fc[fok].astype(int)
+        a = {"key": key, "cols": cols, "available": available}
+        a["gen"] = sp.csr_matrix((Pmax[ok] / available[gc], (find(ok), gc)), shape=(len(gen), nc))
+        a["farms"] = sp.csr_matrix((fPmax[fok] / available[fc], (find(fok), fc)), shape=(len(farms), nc))
+        curt = find(available == 0)  # curtail generation of types without capacity in bid zone
+        a["curtail"] = sp.csr_matrix((np.ones(len(curt)), (curt, curt // len(self.gen_type))), shape=(nc, nz))
+
+        # Load shares, wind farms and generators at buses
+        zi = mult_ind(bus.bidz, self.bidz)
+        ok = ~np.isnan(zi)
+        a["load"] = sp.csr_matrix((arr(bus.load_share)[ok], (find(ok), zi[ok].astype(int))), shape=(nb, nz))
+        a["zone"] = [find(zi == z) for z in range(nz)]
+        a["share"] = arr(bus.load_share).astype(float)
+        fb = mult_ind(farms.bus, bus.index)
+        if np.isnan(fb).any():
+            raise ValueError("Wind farm connected to bus not in self.bus, run prepare_network")
+        a["farm_bus"] = sp.csr_matrix((np.ones(len(fb)), (fb.astype(int), np.arange(len(fb)))), shape=(nb, len(fb)))
+        gb = mult_ind(gen.bus, bus.index)
+        ok = ~np.isnan(gb)
+        a["gen_bus"] = sp.csr_matrix((np.ones(ok.sum()), (gb[ok].astype(int), find(ok))), shape=(nb, len(gb)))
+
+        # DC links: load at bus0 and negative load at bus1 (if in model)
+        ind, val = [], []
+        for b, sign, area in zip(["bus0", "bus1"], [1.0, -1.0], ["area0", "area1"]):
+            lb = mult_ind(link[b], bus.index)
+            ok = ~np.isnan(lb)
+            ind.append((lb[ok].astype(int), find(ok)))
+            val.append(np.full(ok.sum(), sign))
+            if warnings:
+                for i in link.index[~ok & arr(link[area].isin(self.bidz))]:
+                    logger.info("No bus found for link %s (%d)" % (link.at[i, "name"], i))
+        rows, cols = np.concatenate([i[0] for i in ind]), np.concatenate([i[1] for i in ind])
+        a["link_bus"] = sp.csr_matrix((np.concatenate(val), (rows, cols)), shape=(nb, len(link)))
+
+        self.alloc = a
+        return a
+
+    def allocate_power(self, load, gen, link, time=None, gen_equals_load=True):
+        """Distribute bid zone totals on generators, wind farms and buses for many hours at once.
+        time: list of Timestamps, by default all hours in load.index
+        Returns dict with gen, farms and link P and bus load, each (element x hours)."""
+
+        a = self.allocation()
+        if time is None:
+            time = load.index
+        g = arr(gen.loc[time, a["cols"]]).T.astype(float)  # (bid zone, type) x hours
+
+        # Generation (wind on farms), zone totals of types without capacity are curtailed
+        gen_P = a["gen"] @ g
+        farm_P = a["farms"] @ g
+        neg_load = a["curtail"].T @ g
+        if warnings:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                over = find((g > a["available"][:, None]).any(axis=1) & (a["available"] > 0))
+            for i in over:
+                b, t = a["cols"][i]
+                logger.info(
+                    "Not enough %s capacity in %s (%d vs %d MW)" % (t.lower(), b, a["available"][i], g[i].max())
+                )
 
-        # Generation except wind
-        neg_load = pd.DataFrame(0.0, index=self.bidz, columns=["load"])  # Negative load (if generators are missing)
-        self.gen["P"] = 0.0
-        for b in self.bidz:
-            for t in [x for x in self.gen_type if x != "Wind"]:
-                ind = self.gen.index[(self.gen.bidz == b) & (self.gen.type == t)]
-                available = np.sum(
-                    self.gen.loc[ind, "Pmax"]
-                )  # available installed capacity per generation type in bidding zone
-                if available == 0:
-                    neg_load.at[b, "load"] += gen.at[time, (b, t)]  # curtail the non existing generation
-                else:
-                    share = gen.at[time, (b, t)] / available  # share of bid zone max
-                    self.gen.loc[ind, "P"] = (
-                        self.gen.loc[ind, "Pmax"] * share
-                    )  # distributes total generation among generators
-                    if share > 1 and warnings:
-                        logger.info(
-                            "Not enough %s capacity in %s (%d vs %d MW)"
-                            % (t.lower(), b, available, gen.at[time, (b, t)])
-                        )
-
-        # Wind
-        self.farms["P"] = 0.0
-        for b in self.bidz:
-            ind = self.farms.index[self.farms.bidz == b]
-            available = np.sum(self.farms.loc[ind, "Pmax"])  # available installed wind farm capacity in bidding zone
-            if available == 0:
-                neg_load.at[b, "load"] += gen.at[time, (b, "Wind")]  # curtail the excess wind generation
-            else:
-                share = gen.at[time, (b, "Wind")] / available  # share of bid zone max
-                self.farms.loc[ind, "P"] = (
-                    self.farms.loc[ind, "Pmax"] * share
-                )  # distributes total generation among generators
-                if share > 1 and warnings:
-                    logger.info("Not enough wind capacity in %s (%d vs %d MW)" % (b, available, gen.at[time, (b, "Wind")]))
-
-        # Load including wind (+PV) and negative load
-        self.bus["load"] = 0.0
-        for b in self.bidz:
-            ind = self.bus.index[self.bus.bidz == b]
-            bidz_load = (
-                load.at[time, b] - neg_load.at[b, "load"]
-            )  # total consumption in bidding zone - curtailed generation
-            self.bus.loc[ind, "load"] += (
-                self.bus.loc[ind, "load_share"] * bidz_load
-            )  # distrubuting the net consumption among buses
-
-        # wind as negative load - comment out this section if modelling wind as generator
-        for i, row in self.farms.iterrows():
-            self.bus.at[int(row.bus), "load"] -= row.P
+        # Load including wind (+PV) and negative load, wind as negative load
+        bus_load = a["load"] @ (arr(load.loc[time, self.bidz]).T - neg_load) - a["farm_bus"] @ farm_P
 
         # DC (load or negative load at nordic bus)
-        self.link["P"] = link.loc[time, :]
-        self.link.loc[:,"P"] = self.link.P.fillna(0.0)
-        for i, row in self.link.iterrows():
-            try:
-                self.bus.at[row.bus0, "load"] -= row.P
-            except KeyError:
-                if row.area0 in self.bidz and warnings:
-                    logger.info("No bus found for link %s (%d)" % (row["name"], row.name))
-            try:
-                self.bus.at[row.bus1, "load"] += row.P
-            except KeyError:
-                if row.area1 in self.bidz and warnings:
-                    logger.info("No bus found for link %s (%d)" % (row["name"], row.name))
+        link_P = arr(link.reindex(index=time, columns=self.link.index).fillna(0.0)).T.astype(float)
+        bus_load -= a["link_bus"] @ link_P
 
         # Adjust generation so it equals load (for DC power flow)
         """To ensure power balance for dc power flow due to discrepancy in the Nordpool database"""
         if gen_equals_load:
-            imbal = self.gen.P.sum() - self.bus.load.sum()  # + self.farms.P.sum() #uncomment this part for wind as gen
-            for b in self.bidz:
-                ratio = np.sum(self.bus.loc[self.bus.bidz == b, "load"]) / self.bus.load.sum()
-                self.bus.loc[self.bus.bidz == b, "load"] += (
-                    self.bus.loc[self.bus.bidz == b, "load_share"] * ratio * imbal
-                )
+            imbal = gen_P.sum(axis=0) - bus_load.sum(axis=0)
+            for z in a["zone"]:
+                ratio = bus_load[z].sum(axis=0) / bus_load.sum(axis=0)
+                bus_load[z] += a["share"][z, None] * ratio * imbal
+
+        return {"gen": gen_P, "farms": farm_P, "load": bus_load, "link": link_P}
 
     def make_mpc(self):
         """Make matpower/pypower case (mostly DC parameters for now).
@@ -549,7 +763,8 @@ class N490:
         # bus_i | type | Pd | Qd | Gs | Bs | area | Vm | Va | baseKV | zone | Vmax | Vmin
         mpc["bus"] = np.zeros((len(bus), 13))
         mpc["bus"][:, 0] = bus.index
-        mpc["bus"][:, 1] = [2 if np.sum(gen.Pmax.loc[gen.bus == b]) > 0 else 1 for b in bus.index]  # PV = 2 | PQ = 1
+        Pmax = gen.groupby("bus").Pmax.sum().reindex(bus.index).fillna(0)
+        mpc["bus"][:, 1] = np.where(arr(Pmax) > 0, 2, 1)  # PV = 2 | PQ = 1
         mpc["bus"][find(mpc["bus"][:, 1] == 2)[0], 1] = 3  # slack bus
         mpc["bus"][:, 2] = bus.load
         mpc["bus"][:, 6] = mult_ind(bus.bidz, self.bidz) + 1  # bid zone index as area
@@ -582,7 +797,7 @@ class N490:
         mpc["branch"][:, 3] = br.X
         mpc["branch"][:, 4] = br.B
         mpc["branch"][:, 8] = [1 if np.isnan(ug) else 0 for ug in br.ug]  # transformer off nominal turns ratio
-        mpc["branch"][:, 10] = 1  # 1 for in-service
+        mpc["branch"][:, 10] = br.in_service.fillna(1) if "in_service" in br else 1  # 1 for in-service
         mpc["branch"][:, 11] = -360  # minimum angle difference
         mpc["branch"][:, 12] = 360  # maximum angle difference
 
@@ -599,42 +814,315 @@ class N490:
 
         return mpc
 
+    def dc_solver(self, max_rank=50):
+        """Return DC solver (factorized B') for the present network.
+        The solver is cached and only rebuilt if buses or branches have changed. If only the reactance
+        or in_service status of some branches has changed, the factorization is updated (see DCSolver.update)."""
+
+        br = pd.concat([self.line, self.trafo], sort=False)  # same branch order as make_mpc
+        f = mult_ind(br.bus0, self.bus.index)
+        t = mult_ind(br.bus1, self.bus.index)
+        if np.isnan(f).any() or np.isnan(t).any():
+            raise ValueError("Branch connected to bus not in self.bus, run prepare_network")
+        status = arr(br.in_service.fillna(1)).astype(float) if "in_service" in br else np.ones(len(br))
+        b = status / arr(br.X).astype(float)  # susceptance, 0 if out of service
+        Pmax = self.gen.groupby("bus").Pmax.sum()
+        ref = find(arr(Pmax.reindex(self.bus.index).fillna(0) > 0))[0]  # slack bus, as in make_mpc
+        key = topology_key([len(self.bus), ref, self.baseMVA], f, t, b)
+        if self.dc is not None and self.dc.key == key:
+            return self.dc
+        if (
+            self.dc is not None
+            and self.dc.nb == len(self.bus)
+            and self.dc.ref == ref
+            and np.array_equal(self.dc.f, f)
+            and np.array_equal(self.dc.t, t)
+        ):
+            self.dc.update(b, max_rank)
+        else:
+            self.dc = DCSolver(len(self.bus), f, t, b, ref, self.baseMVA)
+        return self.dc
+
+    def set_branch_status(self, line=[], trafo=[], status=0):
+        """Take lines and/or trafos (ids) out of service (status=0) or back in service (status=1).
+        Stored in column in_service, the DC factorization is updated instead of rebuilt.
+        If the change islands the network it is undone and ValueError is raised."""
+
+        old = self.line.copy(), self.trafo.copy()
+        for df, ind in zip([self.line, self.trafo], [line, trafo]):
+            if "in_service" not in df:
+                df["in_service"] = 1
+            df.loc[ind, "in_service"] = status
+        self.update_dc_solver(old)
+
+    def update_branch(self, line=[], trafo=[], **params):
+        """Change parameters of lines and/or trafos (ids), e.g. update_branch(line=[2300], X=0.01).
+        Changes in X are applied as an update of the DC factorization instead of a rebuild.
+        If the change islands the network it is undone and ValueError is raised."""
+
+        old = self.line.copy(), self.trafo.copy()
+        for df, ind in zip([self.line, self.trafo], [line, trafo]):
+            for p, v in params.items():
+                df.loc[ind, p] = v
+        self.update_dc_solver(old)
+
+    def update_dc_solver(self, old):
+        """Update DC solver after a branch change, restore (line, trafo) in old if the update fails"""
+        try:
+            self.dc_solver()
+        except (ValueError, RuntimeError) as err:  # islanded network, singular B'
+            self.line, self.trafo = old
+            self.dc_solver()  # back to the previous case
+            raise ValueError(str(err)) from err
+
+    def ptdf(self):
+        """PTDF matrix (branch x bus), with branches ordered as in make_mpc (lines, then trafos)
+        and buses as in self.bus. Branch flows in MW are ptdf() @ bus_injection()."""
+        return self.dc_solver().ptdf(self.cache_dir)
+
+    def lodf(self):
+        """LODF matrix (branch x branch), column k gives the flow change on all branches
+        per MW on branch k when k is disconnected (nan if the outage islands the network)."""
+        return self.dc_solver().lodf(self.cache_dir)
+
+    def bus_injection(self):
+        """Net injection (generation - load) in MW at each bus from self.gen.P and self.bus.load"""
+        ind = mult_ind(self.gen.bus, self.bus.index)
+        ok = ~np.isnan(ind)
+        P = np.bincount(ind[ok].astype(int), weights=arr(self.gen.P)[ok], minlength=len(self.bus))
+        return P - arr(self.bus.load)
+
     def dcpf(self, time=0, mpc=None, save2network=True):
-        """Run DC power flow"""
+        """Run DC power flow with the cached sparse solver (see dc_solver).
+        If a case mpc is given it is solved with pypower rundcpf instead."""
 
         if type(time) is int:
             time = self.flow_modelled.index[time]
         if mpc is None:
-            mpc = self.make_mpc()
-        mpc = rundcpf(
-            mpc,
-            ppoption(
-                VERBOSE=0,
-                OUT_ALL=-1,
-                OUT_BUS=0,
-                OUT_ALL_LIM=0,
-                OUT_BRANCH=0,
-                OUT_SYS_SUM=0,
-            ),
+            dc = self.dc_solver()
+            Va, Pf = dc.solve(self.bus_injection())
+        else:
+            mpc = rundcpf(
+                mpc,
+                ppoption(
+                    VERBOSE=0,
+                    OUT_ALL=-1,
+                    OUT_BUS=0,
+                    OUT_ALL_LIM=0,
+                    OUT_BRANCH=0,
+                    OUT_SYS_SUM=0,
+                ),
+            )
+            br = mpc[0]["branch"]
+            Va, Pf = mpc[0]["bus"][:, 8], br[:, 13]
+
+        n = self.results.index([time])[0]
+        self.results.set(n, Va, Pf)
+
+        self.set_flow_modelled([time], Pf[:, None])  # AC exchange between areas
+        if save2network:
+            self.mpc2network(n)  # add parameters to network (flows, voltage angle etc.)
+
+    def dcpf_batch(self, P, time=None):
+        """Run DC power flow for many hours in one sparse solve.
+        P: bus injections (bus x hours), e.g. from bus_injections()
+        time: index of the hours in P, by default self.flow_modelled.index
+        Returns branch flows (branch x hours) in MW, flow_modelled is filled for all hours."""
+
+        if time is None:
+            time = self.flow_modelled.index
+        dc = self.dc_solver()
+        Va, Pf = dc.solve(P)
+        self.results.set(self.results.index(time), Va, Pf)
+
+        self.set_flow_modelled(time, Pf)  # AC exchange between areas
+        return Pf
+
+    def exchange_map(self):
+        """Links and AC lines between pairs of areas, as dict with
+        links: (a0, a1) -> ids of links from a0 to a1 and ac: set of (a0, a1) connected by AC lines (both orders).
+        Cached, rebuilt if the areas of links or lines change."""
+
+        key = topology_key(
+            pd.util.hash_pandas_object(self.link.loc[:, ["area0", "area1"]]).values,
+            pd.util.hash_pandas_object(self.line.loc[:, ["area0", "area1"]], index=False).values,
         )
-        self.solved_mpc.append(mpc)
-
-        # AC exchange between areas
-        br = mpc[0]["branch"]
-        ac_flow = pd.DataFrame(0.0, index=[time], columns=list(self.flow_modelled))
-        bid0 = arr(self.bus.loc[br[:, 0], "bidz"])
-        bid1 = arr(self.bus.loc[br[:, 1], "bidz"])
-        for n, a0 in enumerate(self.bidz):
-            for a1 in self.bidz[n + 1 :]:
-                ind0 = (bid0 == a0) & (bid1 == a1)  # find lines between areas
-                ind1 = (bid0 == a1) & (bid1 == a0)  # -"- but reverse flow direction
-                if np.sum(ind0) + np.sum(ind1) > 0:
-                    exch = -np.sum(br[ind0, 13]) + np.sum(br[ind1, 13])
-                    ac_flow.loc[time, "%s-%s" % (a0, a1)] = exch
-        for i in list(ac_flow):
-            self.flow_modelled.at[time, i] = ac_flow.at[time, i]
+        if self.exch is not None and self.exch["key"] == key:
+            return self.exch
+
+        links = {}
+        for i, a0, a1 in zip(self.link.index, self.link.area0, self.link.area1):
+            links.setdefault((a0, a1), []).append(i)
+        ac = set(zip(self.line.area0, self.line.area1))
+        ac |= set((a1, a0) for a0, a1 in ac)
+        self.exch = {"key": key, "links": links, "ac": ac}
+        return self.exch
+
+    def interfaces(self):
+        """Interfaces (pairs of bid zones connected by AC branches) and sparse incidence matrix
+        (interface x branch) giving the exchange a0-a1 from branch flows, branches as in make_mpc.
+        Cached, rebuilt if the topology or bid zones of buses change."""
+
+        dc = self.dc_solver()
+        key = dc.key + topology_key(pd.util.hash_pandas_object(self.bus.bidz, index=False).values)
+        if self.intf is not None and self.intf["key"] == key:
+            return self.intf["names"], self.intf["K"]
+
+        zi = mult_ind(self.bus.bidz, self.bidz).astype(float)
+        z0, z1 = zi[dc.f], zi[dc.t]
+        ok = ~np.isnan(z0) & ~np.isnan(z1) & (z0 != z1)  # AC branches between two bid zones
+        lo, hi = np.minimum(z0[ok], z1[ok]).astype(int), np.maximum(z0[ok], z1[ok]).astype(int)
+        pair = lo * len(self.bidz) + hi  # "first" bid zone first, as in self.bidz
+        upair, row = np.unique(pair, return_inverse=True)
+        sign = np.where(z0[ok] < z1[ok], -1.0, 1.0)  # a0 -> a1 counted negative (pypower flow convention)
+        K = sp.csr_matrix((sign, (row, find(ok))), shape=(len(upair), dc.nl))
+        names = ["%s-%s" % (self.bidz[p // len(self.bidz)], self.bidz[p % len(self.bidz)]) for p in upair]
+        self.intf = {"key": key, "names": names, "K": K}
+        return names, K
+
+    def ac_exchange(self, Pf):
+        """AC exchange between bid zones from branch flows Pf (branch or branch x hours)
+        Returns interface names 'a0-a1' and exchange (interface or interface x hours)"""
+        names, K = self.interfaces()
+        return names, K @ Pf
+
+    def set_flow_modelled(self, time, Pf):
+        """Store AC exchange from branch flows Pf (branch x hours) in flow_modelled for the hours in time"""
+        names, flow = self.ac_exchange(Pf)
+        new = [i for i in names if i not in self.flow_modelled]
+        if len(new) > 0:
+            self.flow_modelled = self.flow_modelled.reindex(columns=list(self.flow_modelled) + new)
+        self.flow_modelled.loc[time, :] = 0.0
+        self.flow_modelled.loc[time, names] = flow.T
+
+    def branch_flows(self, hours=None):
+        """Branch flows (branch x hours) in MW from solved cases, branches ordered as in make_mpc.
+        hours: hour numbers in self.time, by default all solved hours"""
+        return self.results.flows(hours)
+
+    def contingency_scan(self, lines=None, hours=None, limit=1.0, chunk=24):
+        """N-1 screening of line outages using LODFs on top of the base-case flows (no re-solving).
+        lines: ids of lines to take out, by default all lines
+        hours: hour numbers in self.time to screen (e.g. after time_series), by default all solved
+        limit: overload threshold as share of the line capacity Cap (see branch_params)
+        chunk: number of hours evaluated at once, limits memory use
+        Yields one DataFrame per chunk with the overloads found (time, outage, line, flow, cap, loading),
+        e.g. res = pd.concat(m.contingency_scan())"""
+
+        if "Cap" not in self.line:
+            raise ValueError("Line capacities missing, run branch_params() first")
+        if lines is None:
+            lines = self.line.index
+        if hours is None:
+            hours = find(self.results.solved)
+        time = self.results.time
+
+        L = self.lodf()
+        out = mult_ind(lines, self.line.index)
+        if np.isnan(out).any():
+            raise ValueError("Unknown line ids: %s" % str(arr(lines)[np.isnan(out)]))
+        out = out.astype(int)
+        island = np.isnan(L[:, out]).all(axis=0)
+        if island.any():
+            islanding = arr(self.line.index[out[island]])
+            logger.info("Outage of lines %s islands the network, not evaluated" % str(islanding))
+        out = out[~island]
+        cap = arr(self.line.Cap).astype(float)
+        mon = find(cap > 0)  # monitored lines (known capacity)
+        Lmo = L[np.ix_(mon, out)]
+
+        hours = arr(list(hours))
+        for i in range(0, len(hours), chunk):
+            h = hours[i : i + chunk]
+            Pf = self.branch_flows(h)
+            post = Pf[mon, None, :] + Lmo[:, :, None] * Pf[None, out, :]  # monitored x outage x hour
+            loading = np.abs(post) / cap[mon, None, None]
+            n, o, m = np.nonzero((loading > limit).transpose(2, 1, 0))  # sorted by time
+            yield pd.DataFrame(
+                {
+                    "time": time[h[n]],
+                    "outage": self.line.index[out[o]],
+                    "line": self.line.index[mon[m]],
+                    "flow": post[m, o, n],
+                    "cap": cap[mon[m]],
+                    "loading": loading[m, o, n],
+                }
+            )
+
+    def ac_solver(self):
+        """Return AC solver (Ybus, bus types, last solution) for the present network.
+        The solver is cached and rebuilt if branch parameters or bus types have changed."""
+
+        key = self.ac_key()
+        if self.ac is not None and self.ac.key == key:
+            return self.ac
+        mpc = self.make_mpc()
+        bus, branch, gen = mpc["bus"], mpc["branch"], mpc["gen"]
+        bus[:, 0] = np.arange(len(bus))  # internal bus numbering (row in self.bus)
+        branch[:, 0] = mult_ind(branch[:, 0], self.bus.index)
+        branch[:, 1] = mult_ind(branch[:, 1], self.bus.index)
+        if np.isnan(branch[:, :2]).any():
+            raise ValueError("Branch connected to bus not in self.bus, run prepare_network")
+        gi = mult_ind(gen[:, 0], self.bus.index).astype(float)
+        gen = gen[~np.isnan(gi)]
+        gen[:, 0] = gi[~np.isnan(gi)]
+        self.ac = ACSolver(self.baseMVA, bus, branch, gen, key)
+        return self.ac
+
+    def ac_key(self):
+        """Hash of the network data that determines the AC solver (branches, buses and gen buses),
+        computed from the data frames so that the case is not rebuilt with make_mpc every hour"""
+        parts = [[self.baseMVA], arr(self.bus.index), arr(self.gen.bus), arr(self.gen.Pmax)]
+        for df in [self.line, self.trafo]:
+            for c in ["bus0", "bus1", "R", "X", "B", "ug", "in_service"]:
+                parts.append(arr(df[c]) if c in df else np.zeros(0))
+        return topology_key(*parts)
+
+    def acpf(self, time=0, warm=True, save2network=True, P=None, tol=1e-8, max_it=10):
+        """Run AC power flow (Newton-Raphson) for the present bus loads and generation.
+        warm: start from the previous converged solution, otherwise (or if that fails) from flat start
+        P: net bus injections in MW, by default from self.gen.P and self.bus.load (no reactive load)
+        Iterations and convergence are stored in self.ac_stats. Returns True if converged."""
+
+        if type(time) is int:
+            time = self.flow_modelled.index[time]
+        ac = self.ac_solver()
+        if P is None:
+            P = self.bus_injection()
+        Sbus = P / self.baseMVA + 0j
+        V, conv, it, mis = ac.solve(Sbus, None if warm else ac.flat_start(), tol, max_it)
+        if not conv and warm and ac.V is not None:  # retry from flat start
+            V, conv, it_flat, mis = ac.solve(Sbus, ac.flat_start(), tol, max_it)
+            it += it_flat
+        n = self.results.index([time])[0]
+        self.ac_stats.loc[time, :] = [it, conv, mis]
+
+        if not conv:
+            logger.info("%s: AC power flow did not converge (%d iterations, mismatch %.2e)" % (time, it, mis))
+            self.flow_modelled.loc[time, :] = np.nan
+            return False
+        logger.debug("%s: AC power flow converged in %d iterations" % (time, it))
+        Pf = ac.flows(V)
+        self.results.set(n, np.angle(V, deg=True), Pf, np.abs(V))
+        self.set_flow_modelled([time], Pf[:, None])  # AC exchange between areas
         if save2network:
-            self.mpc2network()  # add parameters to network (flows, voltage angle etc.)
+            self.mpc2network(n)  # add parameters to network (flows, voltage angle etc.)
+        return True
+
+    def acpf_series(self, P, time=None):
+        """Run AC power flow hour by hour, each hour warm started from the previous one.
+        P: bus injections (bus x hours), e.g. from bus_injections()
+        time: index of the hours in P, by default self.flow_modelled.index"""
+
+        if time is None:
+            time = self.flow_modelled.index
+        for n, t in enumerate(time):
+            self.acpf(t, P=P[:, n], save2network=False)
+        stats = self.ac_stats.loc[time]
+        logger.info(
+            "AC power flow: %d of %d hours converged, %.1f iterations on average"
+            % (stats.converged.sum(), len(time), stats.iterations.mean())
+        )
 
     def compare_flows(self, n=None, plot=True):
         """Compare flow_measured with flow_modelled
@@ -833,9 +1321,7 @@ if __name__ == "__main__":
     if 0:  # test ac
         load, gen, link = m.get_measurements(start)
         m.distribute_power(load, gen, link, gen_equals_load=False)
-        mpc = m.make_mpc()
-        mpc = rundcpf(
-            mpc,
-            ppoption(VERBOSE=0, OUT_ALL=-1, OUT_BUS=0, OUT_ALL_LIM=0, OUT_BRANCH=0),
-        )
-        # mpc = runpf(mpc,ppoption(VERBOSE=0,OUT_ALL=-1,OUT_BUS=0,OUT_ALL_LIM=0,OUT_BRANCH=0,PF_ALG='NR'))
+        m.acpf()
+    if 0:  # ac time series, warm started
+        m.time_series(start, stop, mode="ac")
+        logger.info("AC power flow iterations and convergence:\n%s" % m.ac_stats)
@@ -24,6 +24,12 @@
 
     time: 'YYYYMMDD:HH'
 
+    Indexed schema (after migrate()): the same columns but time is stored as an
+    integer, hours since 19700101:00 for hourly tables and YYYYWW for reservoir
+    and inflow, and each table is keyed on (area, time) (transfer for exchange)
+    with a separate index on time, so range queries are index seeks. select_data
+    handles both schemas. Migrate with: python nordpool_db.py migrate [db]
+
 
     Note: For nordpool data for hour 00-01 we have used time stamp YYYYMMDD:00
     ENTSO-E data in UTC, Nordpool data in CET=UTC+1:
@@ -36,55 +42,103 @@ Created on Wed Jan 23 14:09:59 2019
 @author: elisn
 """
 
-import datetime
 import logging
 import sqlite3
+import sys
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import parquet_store
+from help_functions import DatabaseConnection, category_order, time2int
+
 tables = ["consumption", "exchange", "wind", "spotprice", "reservoir", "inflow", "production"]
+weekly_tables = ["reservoir", "inflow"]
+value_columns = {"spotprice": "EUR", "reservoir": "GWh", "inflow": "GWh"}  # others MWh
 
 logger = logging.getLogger("Nordic490.nordpool_db")
 
 
-class Database:
-    def __init__(self, db="Data/nordpool.db"):
+class Database(DatabaseConnection):
+    def __init__(self, db="Data/nordpool.db", parquet=None):
+        """parquet: root of Parquet store (see parquet_store), tables exported there are read from it"""
         self.db = db
+        self.parquet = parquet
+        self.conn = None  # long-lived read-only connection, see connect()
+        self.indexed = {}  # schema of each table, see is_indexed()
         self.tables = tables
-        self.cat = {}
-        # if database file exists, query tables to find valid categories
-        if Path(self.db).exists():
-            # query categories
-            for tab in self.tables:
-                self.cat[tab] = self.query_categories(tab)
-        else:
-            for tab in self.tables:
-                self.cat[tab] = []
+        self.cat = {}  # categories of each table, queried on first use, see categories()
+
+    def categories(self, table):
+        """Valid categories (areas or transfers) for table, queried once and memoized"""
+        if table not in self.cat:
+            if self.use_parquet(table):
+                self.cat[table] = parquet_store.categories(self.parquet, table)
+            elif Path(self.db).exists():
+                self.cat[table] = self.query_categories(table)
+            else:
+                self.cat[table] = []
+        return self.cat[table]
 
     def query_categories(self, table):
-        """Query database to find values for 'area' and 'transfer'"""
+        """Query database to find values for 'area' and 'transfer', in order of first appearance
+        in the table (for migrated tables as stored by migrate, new categories last)"""
 
         if table not in self.tables:
             logger.info("Could not find table " "{0}" " in database".format(table))
             return None
         else:
-            conn = sqlite3.connect(self.db)
-            c = conn.cursor()
+            c = self.connect().cursor()
 
             if table == "exchange":
                 category = "transfer"
             else:
                 category = "area"
 
-            cmd = "SELECT DISTINCT {1} FROM {0}".format(table, category)
+            if self.is_indexed(table):  # skip through the (area, time) key, one seek per category
+                cmd = (
+                    "WITH RECURSIVE cat(v) AS (SELECT min({1}) FROM {0} UNION ALL "
+                    "SELECT (SELECT min({1}) FROM {0} WHERE {1} > v) FROM cat WHERE v IS NOT NULL) "
+                    "SELECT v FROM cat WHERE v IS NOT NULL".format(table, category)
+                )
+            else:
+                cmd = "SELECT DISTINCT {1} FROM {0}".format(table, category)
             c.execute(cmd)
 
             values = []
             for res in c:
                 values.append(res[0])
+            if self.is_indexed(table):  # WITHOUT ROWID, rows are stored in (area, time) order
+                order = [v for v in category_order(self.connect(), table) if v in values]
+                values = order + [v for v in values if v not in order]
             return values
 
+    def use_parquet(self, table):
+        """True if table is read from the Parquet store"""
+        return self.parquet is not None and parquet_store.has_table(self.parquet, table)
+
+    def read_parquet(self, table, categories=[], starttime="", endtime=""):
+        """Rows (value, time, area) as selected in select_data, from the Parquet store"""
+        weekly = table in weekly_tables
+        category = "transfer" if table == "exchange" else "area"
+        return parquet_store.read(
+            self.parquet,
+            table,
+            columns=[value_columns.get(table, "MWh"), "time", category],
+            filters=[(category, "in", categories)] if categories != [] else [],
+            start=time2int(starttime, weekly) if starttime != "" else None,
+            end=time2int(endtime, weekly) if endtime != "" else None,
+            weekly=weekly,
+        )
+
+    def is_indexed(self, table):
+        """True if table has the indexed schema with integer time, see migrate()"""
+        if table not in self.indexed:
+            info = self.connect().execute("PRAGMA table_info({0})".format(table)).fetchall()
+            self.indexed[table] = any(col[1] == "time" and col[2].upper() == "INTEGER" for col in info)
+        return self.indexed[table]
+
     def select_data(self, table, categories=[], starttime="", endtime="", excelfile=""):
         """Select time series from sqlite database with nordpool data. Data
         is returned as a pandas dataframe, and optionally exported to excel file.
@@ -105,9 +159,6 @@ class Database:
         if type(endtime) is not str:
             endtime = str(endtime)
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
         if table == "exchange":
             cmd = "SELECT MWh,time,transfer FROM exchange"
         elif table == "consumption":
@@ -126,14 +177,6 @@ class Database:
             logger.info("Table " "{0}" " does not exist".format(table))
             return None
 
-        cmd_max = "SELECT max(time) FROM {0}".format(table)
-        cmd_min = "SELECT min(time) FROM {0}".format(table)
-
-        # check if some categories don't exist in table:
-        for cat in categories:
-            if cat not in self.cat[table]:
-                logger.info("Category " "{0}" " does not exist in table " "{1}" "".format(cat, table))
-
         if categories != []:
             str_categories = "("
             for idx, cat in enumerate(categories):
@@ -150,53 +193,60 @@ class Database:
             else:
                 cat_cnd = "area in " + str_categories
             conditions.append("category")
+        indexed = self.use_parquet(table) or self.is_indexed(table)  # integer time
         if starttime != "":
-            start_cnd = "time >= " + "'{0}'".format(starttime)
+            if indexed:
+                start_cnd = "time >= {0}".format(time2int(starttime, table in weekly_tables))
+            else:
+                start_cnd = "time >= " + "'{0}'".format(starttime)
             conditions.append("start")
         if endtime != "":
-            end_cnd = "time <= " + "'{0}'".format(endtime)
+            if indexed:
+                end_cnd = "time <= {0}".format(time2int(endtime, table in weekly_tables))
+            else:
+                end_cnd = "time <= " + "'{0}'".format(endtime)
             conditions.append("end")
 
         n = conditions.__len__()
         if n > 0:
             cmd += " WHERE "
-            cmd_max += " WHERE "
-            cmd_min += " WHERE "
             for idx, cnd in enumerate(conditions):
                 if idx > 0:
                     cmd += " AND "
-                    cmd_max += " AND "
-                    cmd_min += " AND "
                 if cnd == "category":
                     cmd += cat_cnd
-                    cmd_max += cat_cnd
-                    cmd_min += cat_cnd
                 elif cnd == "start":
                     cmd += start_cnd
-                    cmd_max += start_cnd
-                    cmd_min += start_cnd
                 elif cnd == "end":
                     cmd += end_cnd
-                    cmd_max += end_cnd
-                    cmd_min += end_cnd
                 else:
-                    logger.info("Unknown condition type: {0}".format(c))
+                    logger.info("Unknown condition type: {0}".format(cnd))
 
-        c.execute(cmd_min)
-        for row in c:
-            start = row[0]
-        c.execute(cmd_max)
-        for row in c:
-            end = row[0]
+        # get data, min and max time are taken from the result
+        if self.use_parquet(table):
+            data = self.read_parquet(table, categories, starttime, endtime)
+        else:
+            data = pd.read_sql_query(cmd, self.connect())
 
-        if start is None:  # if query gave no results then return None
+        # check if some categories don't exist in table (only looked up if they gave no data):
+        found = set(data.iloc[:, 2].unique())
+        for cat in categories:
+            if cat not in found and cat not in self.categories(table):
+                logger.info("Category " "{0}" " does not exist in table " "{1}" "".format(cat, table))
+        if len(data) == 0:  # if query gave no results then return None
             logger.info("Queries for time range gave no result, returning None")
             return None
+        values = data.iloc[:, 0].values.astype(float)
+        tcode, times = pd.factorize(data.iloc[:, 1].values)  # each time parsed once
+        if indexed and table in weekly_tables:
+            times = np.array(["{0}:{1:02d}".format(w // 100, w % 100) for w in times])
+        elif not indexed:
+            times = times.astype(str)
+        ccode, cats = pd.factorize(data.iloc[:, 2].values)
+        start = min(times)
+        end = max(times)
 
         if table == "reservoir" or table == "inflow":  # different time format
-            # sdate = datetime.datetime(int(start[0:4]),1,1) + datetime.timedelta(days=7*(int(start[5:7])-1))
-            # edate = datetime.datetime(int(end[0:4]),1,1) + datetime.timedelta(days=7*(int(end[5:7])-1))
-            # dates = pd.date_range(start=sdate,end=edate,freq='7D')
             start_year = int(start[0:4])
             start_week = int(start[5:])
             end_year = int(end[0:4])
@@ -211,35 +261,86 @@ class Database:
                 dates = firstperiod + middleperiod + lastperiod
             else:
                 dates = ["{0}:{1}".format(start_year, dd_numbers[w]) for w in range(start_week - 1, end_week)]
+            dates = pd.Index(dates)
+            dates = dates.append(pd.Index(times[~np.isin(times, dates)]))  # e.g. week 53
         else:
             # create index for data frame
-            sdate = datetime.datetime(int(start[0:4]), int(start[4:6]), int(start[6:8]), int(start[9:11]))
-            edate = datetime.datetime(int(end[0:4]), int(end[4:6]), int(end[6:8]), int(end[9:11]))
-            dates = pd.date_range(start=sdate, end=edate, freq="h")
+            if indexed:
+                times = pd.to_datetime(times, unit="h")
+            else:
+                times = pd.to_datetime(times, format="%Y%m%d:%H")
+            dates = pd.date_range(start=times.min(), end=times.max(), freq="h")
 
         # find columns for data frame
         if categories == []:  # all areas selected by default
-            categories = self.cat[table]
-
-        # allocate panda data frame for data
-        pd_data = pd.DataFrame(dtype=float, index=dates, columns=categories)
-
-        # get data
-        # logger.info(cmd)
-        c.execute(cmd)
-        for row in c:
-            if table == "reservoir" or table == "inflow":  # different time format
-                date = date = row[1]
-            else:
-                date = datetime.datetime(int(row[1][0:4]), int(row[1][4:6]), int(row[1][6:8]), int(row[1][9:11]))
-            pd_data.at[date, row[2]] = row[0]
+            categories = self.categories(table)
 
-        conn.close()
+        # pivot values into data frame, for duplicate rows the last value is used as before
+        ti = dates.get_indexer(times)[tcode]
+        ci = pd.Index(categories).get_indexer(cats)[ccode]
+        keep = ci >= 0
+        pd_values = np.full((len(dates), len(categories)), np.nan)
+        pd_values[ti[keep], ci[keep]] = values[keep]
+        pd_data = pd.DataFrame(pd_values, index=dates, columns=categories)
 
         return pd_data
 
 
-if __name__ == "__main__":
+def migrate(db="Data/nordpool.db", vacuum=True):
+    """Convert tables in db to the indexed schema: integer time, (area, time) primary key
+    (WITHOUT ROWID) and an index on time. For duplicate rows the last one is kept,
+    as in select_data. The original order of the areas is kept in table category_order.
+    Tables that are already converted are skipped."""
+
+    conn = sqlite3.connect(db)
+    for table in tables:
+        info = conn.execute("PRAGMA table_info({0})".format(table)).fetchall()
+        if len(info) == 0:
+            continue
+        if any(col[1] == "time" and col[2].upper() == "INTEGER" for col in info):
+            logger.info("Table {0} already migrated".format(table))
+            continue
+        category = "transfer" if table == "exchange" else "area"
+        value = [col[1] for col in info if col[1] not in ["time", category]][0]  # MWh, EUR or GWh
+        cats = [row[0] for row in conn.execute("SELECT DISTINCT {1} FROM {0}".format(table, category))]
+        if table in weekly_tables:  # 'YYYY:WW' -> YYYYWW
+            time = "CAST(substr(time,1,4) AS INTEGER)*100 + CAST(substr(time,6) AS INTEGER)"
+        else:  # 'YYYYMMDD:HH' -> hours since 1970
+            time = (
+                "CAST(round((julianday(substr(time,1,4)||'-'||substr(time,5,2)||'-'||substr(time,7,2))"
+                " - 2440587.5)*24) AS INTEGER) + CAST(substr(time,10,2) AS INTEGER)"
+            )
+        with conn:  # one transaction per table
+            conn.execute("BEGIN")
+            # order of categories (columns in select_data), lost in the WITHOUT ROWID table
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS category_order (tab TEXT NOT NULL, category TEXT NOT NULL, "
+                "pos INTEGER NOT NULL, PRIMARY KEY (tab, category))"
+            )
+            conn.execute("DELETE FROM category_order WHERE tab = ?", (table,))
+            conn.executemany("INSERT INTO category_order VALUES (?,?,?)", [(table, c, n) for n, c in enumerate(cats)])
+            conn.execute(
+                "CREATE TABLE {0}_new ({1} TEXT NOT NULL, time INTEGER NOT NULL, {2} FLOAT, "
+                "PRIMARY KEY ({1}, time)) WITHOUT ROWID".format(table, category, value)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO {0}_new SELECT {1}, {2}, {3} FROM {0} ORDER BY rowid".format(
+                    table, category, time, value
+                )
+            )
+            conn.execute("DROP TABLE {0}".format(table))
+            conn.execute("ALTER TABLE {0}_new RENAME TO {0}".format(table))
+            conn.execute("CREATE INDEX {0}_time ON {0} (time)".format(table))
+        logger.info("Migrated table {0}".format(table))
+    if vacuum:
+        conn.execute("VACUUM")
+    conn.close()
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["migrate"]:
+    logging.basicConfig(level=logging.INFO)
+    migrate(*sys.argv[2:3])
+elif __name__ == "__main__":
     db = Database()
     data = db.select_data(table="spotprice", categories=["SYS", "UK"], starttime="20180101:00", endtime="20180102:23")
     print(data)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Columnar Parquet copy of the sqlite databases for multi-year studies.
+
+Each table is stored as a Parquet dataset partitioned by year and area
+(transfer for the Nordpool exchange table), e.g.
+
+    Data/parquet/gen_per_type/year=2018/area=FI/*.parquet
+
+Time is stored as an integer as in the indexed nordpool schema: hours since
+19700101:00, or YYYYWW for the weekly reservoir and inflow tables. Rows are
+sorted on time within each partition so that row groups can be skipped on
+their time statistics, and partitions outside the selected years and areas
+are not read at all.
+
+sqlite remains the source of truth, the store is (re)built from the .db files
+with export(), e.g. python parquet_store.py Data/nordpool.db Data/parquet
+Requires pyarrow.
+"""
+
+import logging
+import os
+import shutil
+import sys
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+
+from help_functions import category_order, connect_db, time2int
+
+logger = logging.getLogger("Nordic490.parquet_store")
+
+
+def export(db, root="Data/parquet", tables=None, weekly_tables=["reservoir", "inflow"]):
+    """Write tables in sqlite file db to Parquet datasets in root, replacing earlier exports.
+    tables: list of table names, by default all tables with time and area (or transfer) columns
+    weekly_tables: tables with time 'YYYY:WW'"""
+
+    conn = connect_db(db, readonly=True)
+    if tables is None:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type ='table'")]
+    for table in tables:
+        cols = [col[1] for col in conn.execute("PRAGMA table_info({0})".format(table))]
+        category = "transfer" if "transfer" in cols else "area"
+        if "time" not in cols or category not in cols:
+            logger.info("Table {0} has no time and area columns, not exported".format(table))
+            continue
+        data = pd.read_sql_query("SELECT * FROM {0}".format(table), conn)
+        path = os.path.join(root, table)
+        if len(data) == 0:
+            shutil.rmtree(path, ignore_errors=True)  # read from sqlite instead of an old export
+            logger.info("Table {0} is empty, not exported".format(table))
+            continue
+        order = category_order(conn, table)  # migrated table, else order of first appearance
+        cats = order + [c for c in pd.unique(data[category]) if c not in order]
+        weekly = table in weekly_tables
+        if data.time.dtype.kind not in "iu":  # text time as in the original schema
+            code, times = pd.factorize(data.time.values)
+            data["time"] = np.array([time2int(t, weekly) for t in times], dtype=np.int64)[code]
+        if weekly:
+            data["year"] = data.time // 100
+        else:
+            data["year"] = pd.to_datetime(data.time, unit="h").dt.year
+        data = data.sort_values([category, "time"], kind="stable")  # keep order of duplicates
+
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        data.to_parquet(tmp, partition_cols=["year", category], index=False)
+        with open(os.path.join(tmp, "_categories.txt"), "w", encoding="utf-8") as f:  # '_' ignored by pyarrow
+            f.write("".join(c + "\n" for c in cats))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        logger.info("Exported {0} rows from table {1}".format(len(data), table))
+    conn.close()
+
+
+def has_table(root, table):
+    """True if root has an exported Parquet dataset for table"""
+    return os.path.isdir(os.path.join(root, table))
+
+
+def categories(root, table):
+    """Areas (or transfers) in the partitions of table, in the same order as in the sqlite
+    table (stored by export), sorted for exports without stored order"""
+    cats = set()
+    path = os.path.join(root, table)
+    for year in os.listdir(path):
+        if year.startswith("year="):
+            for part in os.listdir(os.path.join(path, year)):
+                cats.add(unquote(part.split("=", 1)[1]))  # e.g. 'SE1%20-%20SE2'
+    order = []
+    if os.path.exists(os.path.join(path, "_categories.txt")):
+        with open(os.path.join(path, "_categories.txt"), encoding="utf-8") as f:
+            order = [c for c in f.read().split("\n") if c in cats]
+    return order + sorted(cats.difference(order))
+
+
+def read(root, table, columns, filters=[], start=None, end=None, weekly=False):
+    """Read columns of table for rows with integer time in [start, end] (None -> open interval).
+    filters: additional pyarrow filters, e.g. [("area", "in", ["SE1", "SE2"])]
+    Partition columns (area/transfer) are returned as strings."""
+
+    filters = list(filters)
+    if start is not None:
+        filters += [("year", ">=", year(start, weekly)), ("time", ">=", start)]
+    if end is not None:
+        filters += [("year", "<=", year(end, weekly)), ("time", "<=", end)]
+    data = pd.read_parquet(os.path.join(root, table), columns=columns, filters=filters or None)
+    for col in data.columns:
+        if isinstance(data[col].dtype, pd.CategoricalDtype):  # partition column
+            data[col] = data[col].astype(str)
+    return data
+
+
+def year(time, weekly=False):
+    """Year of integer time (hours since 1970 or YYYYWW)"""
+    if weekly:
+        return time // 100
+    return pd.Timestamp(time * 3600, unit="s").year
+
+
+def time2str(time):
+    """Integer hours since 1970 -> 'YYYYMMDD:HH' strings (each distinct time formatted once)"""
+    code, times = pd.factorize(np.asarray(time))
+    return pd.to_datetime(times, unit="h").strftime("%Y%m%d:%H").values[code]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    export(*sys.argv[1:3])
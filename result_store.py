@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Columnar store for power flow results.
+
+Voltage angles, magnitudes (AC only) and branch flows are kept in preallocated float32 arrays with
+one row per hour, optionally memory mapped to .npy files so that long time
+series don't have to fit in memory.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("Nordic490.result_store")
+
+
+class ResultStore:
+    def __init__(self, time, nb, nl, path=None):
+        """Allocate store for the hours in time, nb buses and nl branches.
+        path: folder for memory mapped arrays (angle.npy, vm.npy, flow.npy), None -> in memory"""
+
+        self.time = pd.DatetimeIndex(time)
+        self.path = path
+        nt = len(self.time)
+        self.solved = np.zeros(nt, dtype=bool)
+        if path is None:
+            self.angle = np.full((nt, nb), np.nan, dtype=np.float32)  # voltage angle (deg)
+            self.vm = np.full((nt, nb), np.nan, dtype=np.float32)  # voltage magnitude (pu), AC only
+            self.flow = np.full((nt, nl), np.nan, dtype=np.float32)  # branch flow (MW)
+        else:
+            os.makedirs(path, exist_ok=True)
+            mm = np.lib.format.open_memmap
+            self.angle = mm(os.path.join(path, "angle.npy"), mode="w+", dtype=np.float32, shape=(nt, nb))
+            self.vm = mm(os.path.join(path, "vm.npy"), mode="w+", dtype=np.float32, shape=(nt, nb))
+            self.flow = mm(os.path.join(path, "flow.npy"), mode="w+", dtype=np.float32, shape=(nt, nl))
+            self.angle[:], self.vm[:], self.flow[:] = np.nan, np.nan, np.nan
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, n):
+        """Results for hour number n as dict with angles Va, magnitudes Vm and branch flows Pf"""
+        if not self.solved[n]:
+            raise KeyError("No solved case for hour %d (%s)" % (n, self.time[n]))
+        return {"Va": self.angle[n], "Vm": self.vm[n], "Pf": self.flow[n]}
+
+    def index(self, time):
+        """Hour numbers for Timestamps in time"""
+        n = self.time.get_indexer(pd.DatetimeIndex(time))
+        if (n < 0).any():
+            raise KeyError("Hours not in result store: %s" % str(list(pd.DatetimeIndex(time)[n < 0])))
+        return n
+
+    def set(self, n, Va, Pf, Vm=None):
+        """Store angles Va (bus or bus x hours), flows Pf (branch or branch x hours)
+        and optionally voltage magnitudes Vm (AC) for hour number(s) n"""
+        self.angle[n] = np.asarray(Va).T
+        self.flow[n] = np.asarray(Pf).T
+        if Vm is not None:
+            self.vm[n] = np.asarray(Vm).T
+        self.solved[n] = True
+
+    def flows(self, hours=None):
+        """Branch flows (branch x hours) in MW, by default for all solved hours"""
+        if hours is None:
+            hours = np.flatnonzero(self.solved)
+        return self.flow[hours].T.astype(float)
+
+    def flush(self):
+        """Write memory mapped arrays to disk"""
+        if self.path is not None:
+            self.angle.flush()
+            self.vm.flush()
+            self.flow.flush()